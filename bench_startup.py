@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+def run_once(script, config_file):
+
+    """
+    Run a single --once pass, returning its wall time and the timings it reports, in ms.
+    """
+
+    run_start = perf_counter()
+
+    process = subprocess.run([sys.executable, script, "--once", "--timing", "-i", config_file],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+
+    wall_time = (perf_counter() - run_start) * 1000
+
+    timings = {}
+
+    for line in process.stdout.decode("utf-8").splitlines():
+        if line.startswith("timing "):
+            for field in line.split()[1:]:
+                name, value = field.split("=")
+                timings[name] = float(value)
+
+    if not timings:
+        raise RuntimeError("No timings from run : {}".format(process.stderr.decode("utf-8")))
+
+    timings["wall_ms"] = wall_time
+
+    return timings
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark workspaceorg --once startup time')
+    parser.add_argument('-i', '--input', required=True, help='Config file to apply')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Number of runs')
+
+    args = parser.parse_args()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workspaceorg.py")
+
+    results = [run_once(script, args.input) for _ in range(args.runs)]
+
+    for name in ("import_ms", "first_placement_ms", "total_ms", "wall_ms"):
+        values = [result[name] for result in results]
+
+        print("{:<20} median {:8.2f} | min {:8.2f} | max {:8.2f}".format(name,
+                                                                       statistics.median(values),
+                                                                       min(values),
+                                                                       max(values)))
+
+if __name__ == "__main__":
+    exit(main())
@@ -20,17 +20,16 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #   SOFTWARE.
 
-from enum import Flag, auto
-import toml
 from LoggerManager.loggermanager import Logger_Manager, Loglevel
 from utils import *
 from exceptions import *
 
 class CommandManager:
 
-    def __init__(self, logger_manager):
+    def __init__(self, logger_manager, display=None):
         self.logger_manager = logger_manager
         self.config_manager = None
+        self.display = display
 
     def set_config_manager(self, config_manager):
         self.config_manager = config_manager
@@ -43,11 +42,16 @@ class CommandManager:
 
         config = self.config_manager.get_active_config()
 
-        for cmd in config.commands:
+        for cmd, timeout in config.commands:
             self.logger_manager.log(Loglevel.INFO,
                                     "launching \"{}\"".format(cmd))
 
-            success, \
-                output = do_shell_exec("{}".format(cmd))
-            if not success:
-               raise GenericError("Command {} failed : %s".format(cmd, output))
+            result = exec_result("{}".format(cmd), display=self.display, timeout=timeout)
+
+            if not result.succeeded():
+               raise GenericError("Command {} failed : {}".format(cmd, result.get_error()))
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "\"{}\" exited with {} after {:.3f} secs".format(cmd,
+                                                                                   result.returncode,
+                                                                                   result.duration))
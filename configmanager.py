@@ -23,7 +23,353 @@
 from utils import *
 from exceptions import *
 from windowmanager import *
-import toml
+from importlib.util import find_spec
+import os
+import re
+
+# Rule keys (and their Exact / Glob / Regex variants) that decide what a rule matches.
+MATCH_KEYS = ("Type", "Description", "Exe", "Cmdline", "Cgroup")
+
+# How far (in pixels) a window can be from where a rule put it and still count as in place.
+DEFAULT_TOLERANCE = 8
+
+# Below this many included files, starting worker processes costs more than it saves.
+PARALLEL_INCLUDE_THRESHOLD = 4
+
+def parse_config_file(config_file):
+
+    """
+    Parse a single config file, with no include handling.
+    """
+
+    import toml
+
+    with open(config_file) as file:
+        return toml.load(file)
+
+def get_include_files(config, config_file):
+
+    """
+    Expand a config's Include entry (a glob pattern or list of them, relative
+    to the including file) into a list of files. Each pattern's matches are
+    sorted, so the merge order is the same whatever order the filesystem
+    lists them in.
+    """
+
+    from glob import glob
+
+    includes = config.pop("Include", [])
+
+    if type(includes) == str:
+        includes = [includes]
+
+    if type(includes) != list or any(type(include) != str for include in includes):
+        raise ConfigError("Include in {} must be a pattern or list of patterns".format(config_file))
+
+    base_dir = os.path.dirname(os.path.abspath(config_file))
+    include_files = []
+
+    for include in includes:
+        matches = sorted(glob(os.path.join(base_dir, os.path.expanduser(include))))
+
+        if not matches:
+            raise ConfigError("Include {} in {} matched no files".format(include, config_file))
+
+        for match in matches:
+            if match not in include_files:
+                include_files.append(match)
+
+    return include_files
+
+def merge_config_section(config, section, included, include_file, sources):
+
+    """
+    Merge one section of an included file into the config, rejecting any
+    entry that is already defined (and saying where).
+    """
+
+    merged = config.setdefault(section, {})
+
+    for name, entry in included.get(section, {}).items():
+        if name in merged:
+            raise ConfigError("{} entry {} in {} already defined in {}".format(section, name,
+                                                                              include_file,
+                                                                              sources[(section,
+                                                                                       name)]))
+        merged[name] = entry
+        sources[(section, name)] = include_file
+
+def load_config_file(config_file):
+
+    """
+    Read the supplied config file and any files it includes, without
+    resolving anything against the current desktops. Included files may only
+    hold Apps and Commands, and are parsed in parallel worker processes when
+    there are enough of them, then merged in include order.
+
+    Only the TOML parsing is spread over cores. Rule validation and pattern
+    compilation stay serial in parse_config, as named desktops can only be
+    resolved once the desktops are known, and compiled patterns can't be
+    passed back from a worker (unpickling compiles them again).
+    """
+
+    config = parse_config_file(config_file)
+
+    return load_include_files(config, config_file, get_include_files(config, config_file))
+
+def load_include_files(config, config_file, include_files):
+
+    """
+    Parse the given included files and merge them into an already read
+    config, see load_config_file. Split out so the includes can be read
+    while other startup work goes on.
+    """
+
+    if not include_files:
+        return config
+
+    if len(include_files) >= PARALLEL_INCLUDE_THRESHOLD:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor() as executor:
+            included_configs = list(executor.map(parse_config_file, include_files,
+                                                 chunksize=max(len(include_files) //
+                                                               ((os.cpu_count() or 1) * 4), 1)))
+    else:
+        included_configs = [parse_config_file(include_file) for include_file in include_files]
+
+    sources = {}
+
+    for section in ("Apps", "Commands"):
+        for name in config.get(section, {}):
+            sources[(section, name)] = config_file
+
+    for include_file, included in zip(include_files, included_configs):
+
+        unexpected = [section for section in included if section not in ("Apps", "Commands")]
+
+        if unexpected:
+            raise ConfigError("Only Apps and Commands allowed in included {}, found {}".format(include_file,
+                                                                                                ", ".join(unexpected)))
+
+        merge_config_section(config, "Apps", included, include_file, sources)
+        merge_config_section(config, "Commands", included, include_file, sources)
+
+    return config
+
+def get_match_predicates(rule_config):
+
+    """
+    Get the match keys of a (not yet parsed) rule, as a dictionary of key to
+    (match type, pattern). Returns None if the rule has none, or any are
+    invalid, which parse_config reports.
+    """
+
+    predicates = {}
+
+    for key in MATCH_KEYS:
+        for suffix, match_type in (("", MatchType.SUBSTRING), ("Exact", MatchType.EXACT),
+                                   ("Glob", MatchType.GLOB), ("Regex", MatchType.REGEX)):
+            if key + suffix not in rule_config:
+                continue
+
+            pattern = rule_config[key + suffix]
+
+            if type(pattern) != str or key in predicates:
+                return None
+
+            predicates[key] = (match_type, pattern)
+
+    return predicates or None
+
+def predicate_implied(predicate, later_predicate):
+
+    """
+    Check whether every value matching a later rule's predicate (or None) also
+    matches an earlier one's. Only substring and exact matches are compared,
+    globs and regexes only imply themselves.
+    """
+
+    if later_predicate is None:
+        return False
+
+    match_type, pattern = predicate
+    later_match_type, later_pattern = later_predicate
+
+    if match_type == MatchType.SUBSTRING:
+        return later_match_type in (MatchType.SUBSTRING, MatchType.EXACT) and \
+            pattern in later_pattern
+
+    return later_match_type == match_type and later_pattern == pattern
+
+def get_contained_patterns(value, patterns):
+
+    """
+    Get the patterns in a set that are substrings of a value, enumerating the
+    value's substrings rather than scanning the set when that is cheaper.
+    """
+
+    if len(value) * (len(value) + 1) // 2 < len(patterns):
+        return {value[start:end] for start in range(len(value) + 1)
+                for end in range(start, len(value) + 1)} & patterns
+
+    return [pattern for pattern in patterns if pattern in value]
+
+def find_shadowed_rules(apps):
+
+    """
+    Find rules that can never match, as an earlier rule matches every window
+    they would, e.g. Type = "xterm" ahead of Type = "xterm" plus a
+    Description. Returns a list of (rule, shadowing rule) name tuples.
+
+    Each earlier rule is indexed on its first predicate, which a rule it
+    shadows must imply, so only those need checking in full.
+    """
+
+    rule_index = {}
+    substring_patterns = {}
+    shadowed = []
+
+    for order, (rule_name, rule_config) in enumerate(apps.items()):
+
+        predicates = get_match_predicates(rule_config)
+
+        if predicates is None:
+            continue
+
+        candidates = []
+
+        for key, (match_type, pattern) in predicates.items():
+            candidates.extend(rule_index.get((key, match_type, pattern), ()))
+
+            if match_type in (MatchType.SUBSTRING, MatchType.EXACT):
+                for earlier_pattern in get_contained_patterns(pattern,
+                                                              substring_patterns.get(key, set())):
+                    candidates.extend(rule_index.get((key, MatchType.SUBSTRING,
+                                                      earlier_pattern), ()))
+
+        shadowing = [(earlier_order, earlier_name)
+                     for earlier_order, earlier_name, earlier_predicates in candidates
+                     if all(predicate_implied(earlier_predicate, predicates.get(key))
+                            for key, earlier_predicate in earlier_predicates.items())]
+
+        if shadowing:
+            shadowed.append((rule_name, min(shadowing)[1]))
+            continue
+
+        first_key = next(iter(predicates))
+        first_match_type, first_pattern = predicates[first_key]
+
+        rule_index.setdefault((first_key, first_match_type, first_pattern),
+                              []).append((order, rule_name, predicates))
+
+        if first_match_type == MatchType.SUBSTRING:
+            substring_patterns.setdefault(first_key, set()).add(first_pattern)
+
+    return shadowed
+
+def log_shadowed_rules(logger_manager, display_configs):
+
+    """
+    Warn about rules that can never match, once per pair of rules however many
+    displays share them.
+    """
+
+    reported = set()
+
+    for _, _, display_config in display_configs:
+        for rule_name, shadowing_rule in find_shadowed_rules(display_config.get("Apps") or {}):
+
+            if (rule_name, shadowing_rule) in reported:
+                continue
+
+            reported.add((rule_name, shadowing_rule))
+            logger_manager.log(Loglevel.WARNING,
+                               "Rule {} is shadowed by rule {} and will never match".format(rule_name,
+                                                                                           shadowing_rule))
+
+def config_needs_hardware(config):
+
+    """
+    Check whether a loaded (but not yet parsed) config has any rules that
+    depend on the monitor setup, so hardware probing can be skipped if not.
+    """
+
+    if config is None:
+        return False
+
+    app_sections = [config.get("Apps", {})]
+
+    for display_config in config.get("Displays", {}).values():
+        app_sections.append(display_config.get("Apps", {}))
+
+    return any("Monitor" in rule_config for apps in app_sections
+               for rule_config in apps.values())
+
+def get_displays(config):
+
+    """
+    Get the (name, display) pairs a config file drives, from its Displays
+    section, or a single default display if it has none. Only needs the main
+    config file, as included files can't add displays.
+    """
+
+    displays = config.get("Displays")
+
+    if displays is None:
+        return [("default", None)]
+
+    if not displays:
+        raise ConfigError("Empty Displays section")
+
+    display_names = []
+
+    for display_name, display_config in displays.items():
+
+        display = display_config.get("Display", "")
+
+        if type(display) != str or not display:
+            raise ConfigError("Missing Display entry in {} display".format(display_name))
+
+        display_names.append((display_name, display))
+
+    return display_names
+
+def get_display_configs(config):
+
+    """
+    Split a loaded config file into per display configs, returning a list of
+    (name, display, config) tuples. Each [Displays.<name>] table needs a Display
+    entry, and can have its own Setup, Apps and Commands sections, with Setup
+    values defaulting to the top level ones. Top level (and included) Apps and
+    Commands are shared by every display, after the display's own, which win
+    if they have the same name. A config with no Displays section is a single
+    config for whatever display we were started on.
+    """
+
+    if config.get("Displays") is None:
+        return [("default", None, config)]
+
+    display_configs = []
+
+    for display_name, display in get_displays(config):
+
+        display_config = config["Displays"][display_name]
+
+        setup = dict(config.get("Setup", {}))
+        setup.update(display_config.get("Setup", {}))
+
+        split_config = {"Setup": setup}
+
+        for section in ("Apps", "Commands"):
+            split_config[section] = dict(display_config.get(section, {}))
+
+            for name, entry in config.get(section, {}).items():
+                split_config[section].setdefault(name, entry)
+
+        display_configs.append((display_name, display, split_config))
+
+    return display_configs
 
 class Config:
 
@@ -32,19 +378,85 @@ class Config:
     different hardware setups for (say) a laptop. Data collected via xrandr
     """
 
-    def __init__(self, max_run_time, sleep_time, demaximise):
+    def __init__(self, max_run_time, sleep_time, demaximise, match_cache_size=1024,
+                 tolerance=DEFAULT_TOLERANCE, max_corrections=3, max_backoff=32, loop_budget=0,
+                 placement_memory="", placement_memory_size=512):
         self.max_run_time = max_run_time
         self.sleep_time = sleep_time
         self.demaximise = demaximise
+        self.match_cache_size = match_cache_size
+        self.tolerance = tolerance
+        self.max_corrections = max_corrections
+        self.max_backoff = max_backoff
+        self.loop_budget = loop_budget
+        self.placement_memory = placement_memory
+        self.placement_memory_size = placement_memory_size
 
         self.win_rules = []
         self.commands = []
 
+        # Rules with an exact type or description are indexed on it, everything else has to be
+        # scanned.
+        self.exact_type_index = {}
+        self.exact_description_index = {}
+        self.scan_rules = []
+
+        # Only look up window processes if some rule actually needs them.
+        self.needs_process = False
+
     def add_rule(self, rule):
+        rule.order = len(self.win_rules)
         self.win_rules.append(rule)
 
-    def add_command(self, cmd):
-        self.commands.append(cmd)
+        if rule.needs_process():
+            self.needs_process = True
+
+        if rule.type_predicate is not None and \
+            rule.type_predicate.match_type == MatchType.EXACT:
+            self.exact_type_index.setdefault(rule.type_predicate.pattern, []).append(rule)
+
+        elif rule.description_predicate is not None and \
+            rule.description_predicate.match_type == MatchType.EXACT:
+            self.exact_description_index.setdefault(rule.description_predicate.pattern,
+                                                    []).append(rule)
+        else:
+            self.scan_rules.append(rule)
+
+    def find_rule(self, win_type, description, process=None):
+
+        """
+        Find the first rule (in config order) that matches the given window type,
+        description and owning process, or None. Indexed rules are checked first, so the scan of the remaining
+        rules can stop as soon as it passes the best match found so far.
+        """
+
+        best_rule = None
+
+        for rule in self.exact_type_index.get(win_type, ()):
+            if rule.matches(win_type, description, process):
+                best_rule = rule
+                break
+
+        for rule in self.exact_description_index.get(description, ()):
+            if best_rule is not None and rule.order > best_rule.order:
+                break
+
+            if rule.matches(win_type, description, process):
+                best_rule = rule
+                break
+
+        for rule in self.scan_rules:
+            if best_rule is not None and rule.order > best_rule.order:
+                break
+
+            if rule.matches(win_type, description, process):
+                best_rule = rule
+                break
+
+        return best_rule
+
+    def add_command(self, cmd, timeout=0):
+        self.commands.append((cmd, timeout))
 
 class ConfigManager:
 
@@ -58,35 +470,146 @@ class ConfigManager:
 
         return self.config
 
+    def get_rule_predicate(self, rule_name, rule_config, key):
+
+       """
+       Get a rule's predicate for a window attribute, which may be given as (for example)
+       Type, TypeExact, TypeGlob or TypeRegex, but only one of them. Returns the compiled
+       MatchPredicate, or None if none was given.
+       """
+
+       match_keys = {key: MatchType.SUBSTRING,
+                     key + "Exact": MatchType.EXACT,
+                     key + "Glob": MatchType.GLOB,
+                     key + "Regex": MatchType.REGEX}
+
+       found_keys = [match_key for match_key in match_keys if match_key in rule_config]
+
+       if len(found_keys) > 1:
+           raise ConfigError("Only one of {} allowed in {} rule".format(", ".join(found_keys),
+                                                                       rule_name))
+
+       if not found_keys:
+           return None
+
+       pattern = rule_config[found_keys[0]]
+       match_type = match_keys[found_keys[0]]
+
+       if type(pattern) != str:
+           raise ConfigError("Unknown {} ({}) in {} rule".format(found_keys[0], pattern,
+                                                                 rule_name))
+
+       # Patterns are compiled once, here, so big rule sets don't pay for it twice.
+       try:
+           return MatchPredicate(pattern, match_type)
+       except re.error as e:
+           raise ConfigError("Invalid {} ({}) in {} rule : {}".format(found_keys[0],
+                                                                      pattern,
+                                                                      rule_name, e))
+
+    def set_rule_layout(self, rule, rule_config, rule_layout):
+
+       """
+       Set up a layout rule, which tiles all the windows it matches rather
+       than giving them one fixed position and size.
+       """
+
+       try:
+           layout = LayoutType(str(rule_layout).lower())
+       except ValueError:
+           raise ConfigError("Unknown Layout ({}) in {} rule".format(rule_layout, rule.name))
+
+       if find_spec("numpy") is None:
+           raise ConfigError("Layout in {} rule needs numpy installed".format(rule.name))
+
+       gap = rule_config.get("Gap", 0)
+
+       if type(gap) != int or gap < 0:
+           raise ConfigError("Unknown Gap ({}) in {} rule".format(gap, rule.name))
+
+       master_ratio = rule_config.get("MasterRatio", 0.5)
+
+       if type(master_ratio) not in {int, float} or not 0.0 < master_ratio < 1.0:
+           raise ConfigError("Unknown MasterRatio ({}) in {} rule".format(master_ratio,
+                                                                          rule.name))
+
+       monitor = rule_config.get("Monitor", "")
+
+       if type(monitor) != str:
+           raise ConfigError("Unknown Monitor ({}) in {} rule".format(monitor, rule.name))
+
+       rule.set_layout(layout, gap, master_ratio, monitor)
+
     def get_config_options(self, config_file):
 
        """
        Get options / rules from the supplied config file.
        """
 
-       with open(config_file) as file:
-           config = toml.load(file)
+       config = load_config_file(config_file)
+
+       log_shadowed_rules(self.logger_manager, [("default", None, config)])
+       self.parse_config(config)
+
+    def parse_config(self, config):
+
+       """
+       Build the active config from an already loaded config file. Named
+       desktops are resolved here, so desktop details must be available.
+       """
 
        # Global setup variables.
        self.config = Config(config['Setup'].get("MaxTime", 60),
                             config['Setup'].get("SleepTime", 5),
-                            config['Setup'].get("Demaximise", False))
+                            config['Setup'].get("Demaximise", False),
+                            config['Setup'].get("MatchCacheSize", 1024),
+                            config['Setup'].get("Tolerance", DEFAULT_TOLERANCE),
+                            config['Setup'].get("MaxCorrections", 3),
+                            config['Setup'].get("MaxBackoff", 32),
+                            config['Setup'].get("LoopBudget", 0),
+                            config['Setup'].get("PlacementMemory", ""),
+                            config['Setup'].get("PlacementMemorySize", 512))
+
+       if type(self.config.match_cache_size) != int or self.config.match_cache_size < 1:
+           raise ConfigError("Invalid MatchCacheSize ({})".format(self.config.match_cache_size))
+
+       if type(self.config.tolerance) != int or self.config.tolerance < 0:
+           raise ConfigError("Invalid Tolerance ({})".format(self.config.tolerance))
+
+       if type(self.config.max_corrections) != int or self.config.max_corrections < 1:
+           raise ConfigError("Invalid MaxCorrections ({})".format(self.config.max_corrections))
+
+       if type(self.config.max_backoff) != int or self.config.max_backoff < 1:
+           raise ConfigError("Invalid MaxBackoff ({})".format(self.config.max_backoff))
+
+       if type(self.config.loop_budget) not in {int, float} or self.config.loop_budget < 0:
+           raise ConfigError("Invalid LoopBudget ({})".format(self.config.loop_budget))
+
+       if type(self.config.placement_memory) != str:
+           raise ConfigError("Invalid PlacementMemory ({})".format(self.config.placement_memory))
+
+       if type(self.config.placement_memory_size) != int or self.config.placement_memory_size < 1:
+           raise ConfigError("Invalid PlacementMemorySize ({})".format(self.config.placement_memory_size))
 
        programs = config.get("Apps", {})
 
        if programs is None:
            raise ConfigError("No app rules in config file")
 
+       for item, rule_config in programs.items():
 
-       for item in programs:
+           type_predicate = self.get_rule_predicate(item, rule_config, "Type")
+           description_predicate = self.get_rule_predicate(item, rule_config, "Description")
 
-           rule_type = config['Apps'][item].get("Type", "")
-           rule_description = config['Apps'][item].get("Description", "")
+           process_predicates = [self.get_rule_predicate(item, rule_config, process_key)
+                                 for process_key in ("Exe", "Cmdline", "Cgroup")]
 
-           if not rule_type and not rule_description:
-               raise ConfigError("Missing type or description entry in {} rule".format(item))
+           if type_predicate is None and description_predicate is None and \
+               not any(process_predicates):
+               raise ConfigError("Missing type, description or process entry in {} rule".format(item))
 
-           config_desktop = config['Apps'][item].get("Desktop", -1)
+           config_desktop = rule_config.get("Desktop", -1)
+           rule_desktop_name = None
 
            if type(config_desktop) == int:
                rule_desktop = config_desktop
@@ -95,37 +618,38 @@ class ConfigManager:
                    raise ConfigError("Missing desktop entry in {} rule".format(config_desktop,
                                                                                item))
            else:
+               rule_desktop_name = config_desktop
                rule_desktop = self.window_manager.get_desktop_index(config_desktop)
 
                if rule_desktop == -1:
                    raise ConfigError("Unknown desktop {} in {} rule".format(config_desktop,
                                                                             item))
 
-           rule_posx = config['Apps'][item].get("Pos_x", -1)
+           rule_posx = rule_config.get("Pos_x", -1)
 
            if type(rule_posx) not in {int, float}:
                raise ConfigError("Unknown Pos_x ({}) in {} rule".format(rule_posx,
                                                                         item))
 
-           rule_posy = config['Apps'][item].get("Pos_y", -1)
+           rule_posy = rule_config.get("Pos_y", -1)
 
            if type(rule_posy) not in {int, float}:
                raise ConfigError("Unknown Pos_y ({}) in {} rule".format(rule_posy,
                                                                         item))
 
-           rule_sizex = config['Apps'][item].get("Size_x", -1)
+           rule_sizex = rule_config.get("Size_x", -1)
 
            if type(rule_sizex) not in {int, float}:
                raise ConfigError("Unknown Size_x ({}) in {} rule".format(rule_sizex,
                                                                          item))
-           rule_sizey = config['Apps'][item].get("Size_y", -1)
+           rule_sizey = rule_config.get("Size_y", -1)
 
            if type(rule_sizey) not in {int, float}:
                raise ConfigError("Unknown Size_y ({}) in {} rule".format(rule_sizey,
                                                                          item))
 
            flags = WindowFlag.NONE
-           rule_flags = config['Apps'][item].get("Flags", "")
+           rule_flags = rule_config.get("Flags", "")
 
            if rule_flags.lower() == "maximised" or rule_flags.lower() == "maximized":
                flags |= WindowFlag.MAXIMISED
@@ -138,16 +662,33 @@ class ConfigManager:
                                  rule_sizey,
                                  flags)
 
-           if rule_type:
-               new_rule.set_win_type(rule_type)
+           if rule_desktop_name is not None:
+               new_rule.set_desktop_name(rule_desktop_name)
+
+           rule_once = rule_config.get("Once", False)
+
+           if type(rule_once) != bool:
+               raise ConfigError("Unknown Once ({}) in {} rule".format(rule_once, item))
+
+           new_rule.set_place_once(rule_once)
 
-           if rule_description:
-               new_rule.set_win_description(rule_description)
+           rule_layout = rule_config.get("Layout", "")
+
+           if rule_layout:
+               self.set_rule_layout(new_rule, rule_config, rule_layout)
+
+           if type_predicate is not None:
+               new_rule.set_win_type(type_predicate)
+
+           if description_predicate is not None:
+               new_rule.set_win_description(description_predicate)
+
+           new_rule.set_process_predicates(*process_predicates)
 
            self.logger_manager.log(Loglevel.INFO,
                                    "Adding rule {} - type {}, description {} => {}".format(item,
-                                                                                           rule_type,
-                                                                                           rule_description,
+                                                                                           new_rule.win_type,
+                                                                                           new_rule.description,
                                                                                            rule_desktop))
 
            self.config.add_rule(new_rule)
@@ -156,11 +697,18 @@ class ConfigManager:
        # Commands to be launched
        commands = config.get("Commands", {})
 
-       for cmd_name in commands:
-           cmd = config['Commands'][cmd_name].get("Command", "")
+       for cmd_name, cmd_config in commands.items():
+           cmd = cmd_config.get("Command", "")
            if not cmd:
                raise ConfigError("Missing Command entry in {} command".format(cmd_name))
 
            self.logger_manager.log(Loglevel.INFO,
                                    "Adding command {} - {}".format(cmd_name, cmd))
-           self.config.add_command(cmd)
+           # Commands wait until they finish by default, as they always have.
+           cmd_timeout = cmd_config.get("Timeout", 0)
+
+           if type(cmd_timeout) not in {int, float} or cmd_timeout < 0:
+               raise ConfigError("Unknown Timeout ({}) in {} command".format(cmd_timeout,
+                                                                             cmd_name))
+
+           self.config.add_command(cmd, cmd_timeout)
@@ -0,0 +1,321 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+
+from windowmanager import *
+from hardwaremanager import *
+from configmanager import ConfigManager, config_needs_hardware
+from commandmanager import CommandManager
+
+from LoggerManager.loggermanager import Logger_Manager, Loglevel
+from exceptions import *
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+from time import sleep, time
+from traceback import format_exc
+
+def timed_probe(probe, *probe_args):
+
+    """
+    Run a single startup probe, returning its result and how long it took.
+    """
+
+    probe_start = time()
+    result = probe(*probe_args)
+
+    return result, time() - probe_start
+
+
+class DisplaySession:
+
+    """
+    Everything needed to organise the windows on a single X display. A display of None means
+    whatever display we were started on.
+    """
+
+    def __init__(self, logger_manager, name, display=None):
+        self.logger_manager = logger_manager
+        self.name = name
+        self.display = display
+
+        self.window_manager = WindowManager(logger_manager, display)
+        self.hardware_manager = HardwareManager(logger_manager, display)
+        self.config_manager = ConfigManager(logger_manager, self.window_manager)
+        self.command_manager = CommandManager(logger_manager, display)
+        self.snapshot_manager = None
+
+        self.window_manager.set_config_manager(self.config_manager)
+        self.window_manager.set_hardware_manager(self.hardware_manager)
+        self.command_manager.set_config_manager(self.config_manager)
+
+        self.snapshot_file = None
+        self.state_writer = None
+        self.placement_store = None
+
+        self.active = False
+        self.start_time = 0.0
+        self.next_due = 0.0
+        self.loop_counter = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def log(self, level, message):
+        self.logger_manager.log(level, "[{}] {}".format(self.name, message))
+
+    def get_snapshot_manager(self):
+
+        """
+        Get the snapshot manager, which is only created (and imported) if needed.
+        """
+
+        if self.snapshot_manager is None:
+            from snapshotmanager import SnapshotManager
+
+            self.snapshot_manager = SnapshotManager(self.logger_manager, self.window_manager)
+
+        return self.snapshot_manager
+
+    def run_startup_discovery(self, get_config=None, probe_hardware=True):
+
+        """
+        Run the independent startup probes (hardware, if wanted, desktops and windows)
+        concurrently. The only real dependency is that named desktops in rules need the
+        desktop details, so the config (if any) is parsed as soon as those are available.
+        get_config returns this display's loaded config, and is only called then, so the
+        config can still be being read while the probes run. Hardware is probed late if
+        the config turns out to need it after all.
+        """
+
+        start_time = time()
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+
+            probes = {"desktops": executor.submit(timed_probe,
+                                                  self.window_manager.get_desktop_details),
+                      "windows": executor.submit(timed_probe,
+                                                 self.window_manager.get_window_details)}
+
+            if probe_hardware:
+                probes["hardware"] = executor.submit(timed_probe,
+                                                     self.hardware_manager.get_hardware_setup)
+
+            probes["desktops"].result()
+
+            if get_config != None:
+                config = get_config()
+
+                if "hardware" not in probes and config_needs_hardware(config):
+                    probes["hardware"] = executor.submit(timed_probe,
+                                                         self.hardware_manager.get_hardware_setup)
+
+                self.config_manager.parse_config(config)
+                self.load_placement_store()
+
+            for probe_name, probe in probes.items():
+                _, probe_time = probe.result()
+                self.log(Loglevel.INFO,
+                         "### Startup probe {} took {:.3f} secs.".format(probe_name, probe_time))
+
+        self.log(Loglevel.INFO,
+                 "### Startup discovery took {:.3f} secs.".format(time() - start_time))
+
+    def load_placement_store(self):
+
+        """
+        Load the remembered placements, if the config asks for them.
+        """
+
+        config = self.config_manager.get_active_config()
+
+        if not config.placement_memory:
+            return
+
+        from placementstore import PlacementStore
+
+        self.placement_store = PlacementStore(self.logger_manager,
+                                              os.path.expanduser(config.placement_memory),
+                                              config.placement_memory_size)
+        self.placement_store.load()
+        self.window_manager.set_placement_store(self.placement_store)
+
+    def start(self):
+
+        """
+        Start the polling loop for this display.
+        """
+
+        self.active = True
+        self.start_time = time()
+        self.next_due = self.start_time
+
+    def is_due(self, now):
+        return self.active and self.next_due <= now
+
+    def run_pass(self, refresh=True):
+
+        """
+        Run a single refresh / apply pass, returns how long it took. Without refresh, rules
+        are only applied to windows that haven't had them applied yet.
+        """
+
+        pass_start = time()
+        config = self.config_manager.get_active_config()
+
+        self.log(Loglevel.INFO, "### Loop {} start.".format(self.loop_counter))
+        self.loop_counter = self.loop_counter + 1
+
+        # Desktop and window details were already fetched during startup discovery.
+        if refresh and self.loop_counter > 1:
+            self.window_manager.refresh_desktops()
+            self.window_manager.get_window_details()
+
+        self.window_manager.apply_rules()
+
+        # Autosave, only what changed since the last snapshot.
+        if self.snapshot_file != None:
+            self.get_snapshot_manager().take_snapshot(self.snapshot_file, True)
+
+        if self.state_writer != None:
+            self.state_writer.publish()
+
+        if self.placement_store != None:
+            self.placement_store.save()
+
+        latency = time() - pass_start
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        self.log(Loglevel.INFO, "### Loop took {:.3f} secs, sleeping for {} secs.".format(latency,
+                                                                                         config.sleep_time))
+
+        self.next_due = time() + config.sleep_time
+
+        return latency
+
+    def fail(self, message):
+
+        """
+        Stop the polling loop for this display after an error in one of its passes or its
+        commands, leaving any other displays running.
+        """
+
+        self.active = False
+        self.log(Loglevel.ERROR, "Display stopped : {}".format(message))
+
+    def run_once(self):
+
+        """
+        Do a single refresh / apply pass, then finish, rather than polling. There is no later
+        pass for windows the loop budget deferred, so they get extra passes (without a
+        refresh, so each one places at least one more window) until there are none left.
+        """
+
+        self.start()
+        self.run_pass()
+
+        while self.window_manager.deferred_windows:
+            self.run_pass(False)
+
+        self.finish()
+
+    def finish(self):
+
+        """
+        Stop the polling loop, and launch any configured commands.
+        """
+
+        self.active = False
+
+        if self.loop_counter > 0:
+            self.log(Loglevel.INFO,
+                     "### {} loops, mean latency {:.3f} secs, max {:.3f} secs.".format(self.loop_counter,
+                                                                                     self.total_latency / self.loop_counter,
+                                                                                     self.max_latency))
+
+        self.command_manager.launch()
+
+
+def run_display_sessions(logger_manager, sessions):
+
+    """
+    Drive the polling loops of all display sessions from one scheduler. Each display's passes,
+    and its commands once it finishes, run on a worker thread of their own, so a slow or
+    failing display never holds up the others. We wait until the next pass is due or some
+    display's work completes, whichever comes first.
+    """
+
+    for session in sessions:
+        session.start()
+
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+
+        while True:
+
+            now = time()
+            busy = set(running.values())
+            wake_time = None
+
+            for session in sessions:
+                if not session.active or session in busy:
+                    continue
+
+                config = session.config_manager.get_active_config()
+                finish_time = session.start_time + config.max_run_time
+
+                if now >= finish_time:
+                    # Stop scheduling passes straight away, finish() runs the commands.
+                    session.active = False
+                    running[executor.submit(session.finish)] = session
+
+                elif session.is_due(now):
+                    running[executor.submit(session.run_pass)] = session
+
+                else:
+                    session_wake = min(session.next_due, finish_time)
+
+                    if wake_time is None or session_wake < wake_time:
+                        wake_time = session_wake
+
+            if not running and not any(session.active for session in sessions):
+                break
+
+            timeout = None if wake_time is None else max(wake_time - time(), 0)
+
+            if not running:
+                sleep(timeout)
+                continue
+
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            # A failing display only stops itself.
+            for display_work in done:
+                session = running.pop(display_work)
+
+                try:
+                    display_work.result()
+                except AppError as e:
+                    session.fail(e.GetMessage())
+                except Exception:
+                    session.fail(format_exc())
@@ -55,9 +55,10 @@ class HardwareManager:
     various setups
     """
 
-    def __init__(self, logger_manager):
+    def __init__(self, logger_manager, display=None):
          self.monitors = {}
          self.logger_manager = logger_manager
+         self.display = display
 
     def get_hardware_setup(self):
 
@@ -66,15 +67,15 @@ class HardwareManager:
 
     def get_attached_monitors(self):
 
-        success, output = do_shell_exec("xrandr --props")
+        result = exec_result("xrandr --props", display=self.display)
 
-        if not success:
-            raise GenericError("xrandr failed : {}".format(output))
+        if not result.succeeded():
+            raise GenericError("xrandr failed : {}".format(result.get_error()))
 
         waiting_edid_marker = False
         waiting_edid = False
 
-        for line in output.splitlines():
+        for line in result.stdout.splitlines():
             line_split = line.split()
 
             if len(line_split) > 2 and line_split[1] == "connected":
@@ -0,0 +1,65 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+
+import numpy as np
+
+from windowmanager import LayoutType
+
+def solve_layout(layout, count, region, gap=0, master_ratio=0.5):
+
+    """
+    Work out the geometry of count windows tiled over region (x, y, width, height), returns
+    a count x 4 integer array of (pos_x, pos_y, size_x, size_y) rows, in window order.
+    """
+
+    region_x, region_y, region_width, region_height = region
+    index = np.arange(count)
+
+    if layout == LayoutType.MASTER_STACK and count > 1:
+        # First window takes master_ratio of the width, the rest stack up on the right.
+        master_width = region_width * master_ratio
+        stack_count = count - 1
+        stack_index = np.maximum(index - 1, 0)
+
+        left = np.where(index == 0, 0.0, master_width)
+        width = np.where(index == 0, master_width, region_width - master_width)
+        top = np.where(index == 0, 0.0, stack_index * (region_height / stack_count))
+        height = np.where(index == 0, region_height, region_height / stack_count)
+
+    else:
+        if layout == LayoutType.GRID:
+            columns = int(np.ceil(np.sqrt(count)))
+        else:
+            columns = count
+
+        rows = int(np.ceil(count / columns))
+
+        width = np.full(count, region_width / columns)
+        height = np.full(count, region_height / rows)
+        left = (index % columns) * width
+        top = (index // columns) * height
+
+    geometry = np.stack((region_x + left + gap, region_y + top + gap,
+                         width - (2 * gap), height - (2 * gap)), axis=1)
+
+    return np.maximum(np.floor(geometry), 0).astype(int)
@@ -0,0 +1,76 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+from collections import OrderedDict
+
+class MatchCache:
+
+    """
+    Bounded LRU cache of rule match results, keyed by window type and description. A result
+    of None (no rule matched) is cached as well, so windows no rule cares about are cheap too.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "Entries : {} / {} | Hits : {} | Misses : {}".format(len(self.entries),
+                                                                  self.max_size,
+                                                                  self.hits,
+                                                                  self.misses)
+
+    def lookup(self, key):
+
+        """
+        Look up a cached match, returns a (found, rule) tuple.
+        """
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def store(self, key, rule):
+
+        """
+        Store a match result, evicting the least recently used entry if full.
+        """
+
+        self.entries[key] = rule
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+
+        """
+        Drop all cached results, e.g. because the rules they refer to have changed.
+        """
+
+        self.entries.clear()
@@ -0,0 +1,144 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+
+from collections import OrderedDict
+import json
+import os
+
+from LoggerManager.loggermanager import Logger_Manager, Loglevel
+from exceptions import *
+
+PLACEMENT_STORE_VERSION = 2
+
+class PlacementStore:
+
+    """
+    On disk memory of where the windows of each (window type, rule) ended up, so a new run
+    can tell which windows are already placed. Entries are keyed on the rule rather than
+    the window title, as titles keep changing. Entries are kept in least recently used
+    order, and the oldest are dropped once the store is full.
+    """
+
+    def __init__(self, logger_manager, store_file, max_entries=512):
+        self.logger_manager = logger_manager
+        self.store_file = store_file
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+        self.dirty = False
+
+        # What was remembered from earlier runs. Lookups only see these, so one window
+        # settling this run doesn't make its siblings look placed already.
+        self.remembered = {}
+
+    def load(self):
+
+        """
+        Load the store from disk. A missing or unreadable store just means starting cold.
+        """
+
+        if not os.path.exists(self.store_file):
+            return
+
+        try:
+            with open(self.store_file) as file:
+                store = json.load(file)
+
+            if store.get("version") != PLACEMENT_STORE_VERSION:
+                raise ValueError("version {}".format(store.get("version")))
+
+            for win_type, rule_name, desktop, geometry in store["entries"]:
+                self.entries[(win_type, rule_name)] = {"desktop": desktop,
+                                                       "geometry": geometry}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger_manager.log(Loglevel.INFO,
+                                    "Ignoring placement memory {} : {}".format(self.store_file, e))
+            self.entries.clear()
+            return
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        self.remembered = dict(self.entries)
+
+        self.logger_manager.log(Loglevel.INFO,
+                                "Loaded {} remembered placements".format(len(self.entries)))
+
+    def save(self):
+
+        """
+        Write the store back to disk if it has changed. The new store is fully written and
+        synced before it replaces the old one, so a crash leaves one or the other intact.
+        """
+
+        if not self.dirty:
+            return
+
+        store = {"version": PLACEMENT_STORE_VERSION,
+                 "entries": [[win_type, rule_name, entry["desktop"], entry["geometry"]]
+                             for (win_type, rule_name), entry in self.entries.items()]}
+
+        temp_file = "{}.tmp".format(self.store_file)
+
+        with open(temp_file, "w") as file:
+            json.dump(store, file, separators=(",", ":"))
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_file, self.store_file)
+        self.dirty = False
+
+    def lookup(self, win_type, rule_name):
+
+        """
+        Get the placement remembered from an earlier run for a window type under a rule,
+        or None.
+        """
+
+        return self.remembered.get((win_type, rule_name))
+
+    def record(self, win_type, rule_name, desktop, geometry, tolerance=0):
+
+        """
+        Remember where a window of the given type ended up under a rule. Several windows
+        can share an entry, so it is only changed if a window settled somewhere other than
+        (within tolerance) the remembered place. Only a change of content marks the store
+        as needing a save, the use order is just kept up to date in memory and goes out
+        with the next real change.
+        """
+
+        key = (win_type, rule_name)
+        entry = self.entries.get(key)
+
+        if entry is None or entry["desktop"] != desktop or \
+            any(abs(stored - value) > tolerance for stored, value in zip(entry["geometry"],
+                                                                          geometry)):
+            self.entries[key] = {"desktop": desktop, "geometry": list(geometry)}
+            self.dirty = True
+
+        if next(reversed(self.entries)) != key:
+            self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.dirty = True
@@ -0,0 +1,120 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+
+import os
+
+class ProcessInfo:
+
+    """
+    Details of the process that owns a window, read from /proc
+    """
+
+    def __init__(self, pid, start_time, exe, cmdline, cgroup):
+        self.pid = pid
+        self.start_time = start_time
+        self.exe = exe
+        self.cmdline = cmdline
+        self.cgroup = cgroup
+
+    def __str__(self):
+        return "Pid : {} | Exe : {} | Cmdline : {} | Cgroup : {}".format(self.pid,
+                                                                         self.exe,
+                                                                         self.cmdline,
+                                                                         self.cgroup)
+
+
+class ProcessIndex:
+
+    """
+    Cache of process details keyed by (pid, start time), so each process is only inspected
+    once in its lifetime, and a recycled pid is never mistaken for the process it replaced.
+    """
+
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+        self.processes = {}
+
+    def read_proc_file(self, pid, name):
+        with open(os.path.join(self.proc_root, str(pid), name), "rb") as file:
+            return file.read()
+
+    def get_start_time(self, pid):
+
+        """
+        Get a process's start time (in clock ticks since boot), or None if it has gone.
+        """
+
+        try:
+            stat = self.read_proc_file(pid, "stat")
+        except OSError:
+            return None
+
+        # The command name is in brackets and may itself contain spaces or brackets, so
+        # count fields from the last closing bracket. Start time is field 22.
+        stat_fields = stat[stat.rfind(b")") + 2:].split()
+
+        return int(stat_fields[19])
+
+    def get_process(self, pid):
+
+        """
+        Get the details of a running process, returns None if it does not exist.
+        """
+
+        start_time = self.get_start_time(pid)
+
+        if start_time is None:
+            return None
+
+        process = self.processes.get(pid)
+
+        if process is not None and process.start_time == start_time:
+            return process
+
+        try:
+            exe = os.readlink(os.path.join(self.proc_root, str(pid), "exe"))
+        except OSError:
+            # Not ours to look at, matching on exe just won't work for it.
+            exe = ""
+
+        try:
+            cmdline = self.read_proc_file(pid, "cmdline").rstrip(b"\0").replace(b"\0", b" ")
+            cgroup = self.read_proc_file(pid, "cgroup").strip()
+        except OSError:
+            return None
+
+        process = ProcessInfo(pid, start_time, exe, cmdline.decode("utf-8", "replace"),
+                              cgroup.decode("utf-8", "replace"))
+
+        self.processes[pid] = process
+
+        return process
+
+    def prune(self, live_pids):
+
+        """
+        Forget any processes not in the given set of pids.
+        """
+
+        for pid in [pid for pid in self.processes if pid not in live_pids]:
+            del self.processes[pid]
@@ -0,0 +1,138 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+#   Shared state file layout, all little endian:
+#
+#   Header (64 bytes)
+#       magic "WSOS", version (u16), header size (u16), generation (u64),
+#       max desktops (u32), max windows (u32), desktop count (u32), window count (u32),
+#       current desktop (i32), update time (f64), padding
+#   Desktop records (max desktops of them)
+#       index (i32), width (u32), height (u32), name (64 bytes, utf-8, nul padded)
+#   Window records (max windows of them)
+#       handle (u64), desktop (i32), pos x, pos y, size x, size y (i32),
+#       type (128 bytes), title (256 bytes)
+#
+#   The generation is a seqlock, it is odd while the writer is updating the file. Readers
+#   should read it, read the records, then re-read it, and retry if it was odd or changed.
+
+import mmap
+import os
+import struct
+from time import time
+
+from exceptions import *
+
+STATE_MAGIC = b"WSOS"
+STATE_VERSION = 1
+
+HEADER_STRUCT = struct.Struct("<4sHHQIIIIid20x")
+GENERATION_STRUCT = struct.Struct("<Q")
+GENERATION_OFFSET = 8
+DESKTOP_STRUCT = struct.Struct("<iII64s")
+WINDOW_STRUCT = struct.Struct("<Qiiiii128s256s")
+
+def get_state_size(max_desktops, max_windows):
+
+    """
+    Get the size of a shared state file with the given capacity.
+    """
+
+    return HEADER_STRUCT.size + (DESKTOP_STRUCT.size * max_desktops) + \
+        (WINDOW_STRUCT.size * max_windows)
+
+
+class SharedStateWriter:
+
+    """
+    Publish the window manager's window store and desktop table into a memory mapped file, so
+    other tools can find out where windows are without running wmctrl themselves.
+    """
+
+    def __init__(self, window_manager, state_file, max_desktops=32, max_windows=512):
+        self.window_manager = window_manager
+        self.state_file = state_file
+        self.max_desktops = max_desktops
+        self.max_windows = max_windows
+
+        state_size = get_state_size(max_desktops, max_windows)
+
+        file_handle = os.open(state_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            if os.fstat(file_handle).st_size != state_size:
+                os.ftruncate(file_handle, state_size)
+
+            self.state_map = mmap.mmap(file_handle, state_size)
+        finally:
+            os.close(file_handle)
+
+        # Carry on from an existing file's generation, so readers never see it go backwards.
+        header = HEADER_STRUCT.unpack_from(self.state_map, 0)
+
+        if header[0] == STATE_MAGIC:
+            self.generation = (header[3] + 1) & ~1
+        else:
+            self.generation = 0
+
+    def set_generation(self, generation):
+        self.generation = generation
+        GENERATION_STRUCT.pack_into(self.state_map, GENERATION_OFFSET, generation)
+
+    def publish(self):
+
+        """
+        Write the current desktops and windows into the shared state file.
+        """
+
+        desktops = list(self.window_manager.desktops.values())[:self.max_desktops]
+
+        windows = [win for win_type in self.window_manager.win_dict
+                   for win in self.window_manager.win_dict[win_type]][:self.max_windows]
+
+        # Odd generation, readers retry until we are done.
+        self.set_generation(self.generation + 1)
+
+        for desktop_count, desktop in enumerate(desktops):
+            DESKTOP_STRUCT.pack_into(self.state_map,
+                                     HEADER_STRUCT.size + (DESKTOP_STRUCT.size * desktop_count),
+                                     desktop.index, desktop.width, desktop.height,
+                                     desktop.name.encode("utf-8")[:64])
+
+        windows_offset = HEADER_STRUCT.size + (DESKTOP_STRUCT.size * self.max_desktops)
+
+        for window_count, win in enumerate(windows):
+            WINDOW_STRUCT.pack_into(self.state_map,
+                                    windows_offset + (WINDOW_STRUCT.size * window_count),
+                                    int(win.win_handle, 16), win.desktop, win.pos_x, win.pos_y,
+                                    win.size_x, win.size_y, win.win_type.encode("utf-8")[:128],
+                                    win.description.encode("utf-8")[:256])
+
+        HEADER_STRUCT.pack_into(self.state_map, 0, STATE_MAGIC, STATE_VERSION,
+                                HEADER_STRUCT.size, self.generation, self.max_desktops,
+                                self.max_windows, len(desktops), len(windows),
+                                self.window_manager.current_desktop, time())
+
+        self.set_generation(self.generation + 1)
+
+    def close(self):
+        self.state_map.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+import argparse
+import mmap
+from time import monotonic, sleep
+
+from sharedstate import *
+
+class SharedStateReader:
+
+    """
+    Read the window / desktop state published by a running workspaceorg, straight out of
+    the memory mapped state file.
+    """
+
+    def __init__(self, state_file, timeout=1.0, retry_sleep=0.0005):
+        self.timeout = timeout
+        self.retry_sleep = retry_sleep
+
+        with open(state_file, "rb") as file:
+            self.state_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.state_map) < HEADER_STRUCT.size or \
+            self.state_map[:len(STATE_MAGIC)] != STATE_MAGIC:
+            raise GenericError("{} is not a workspaceorg state file".format(state_file))
+
+    def get_generation(self):
+        return GENERATION_STRUCT.unpack_from(self.state_map, GENERATION_OFFSET)[0]
+
+    def read(self):
+
+        """
+        Read a consistent copy of the state, returns a (current desktop, desktops, windows)
+        tuple, with desktops and windows as lists of dictionaries. Reads that overlap a
+        write are retried, with a short sleep to let the writer finish, until the timeout.
+        """
+
+        deadline = monotonic() + self.timeout
+
+        while True:
+            generation = self.get_generation()
+
+            if generation & 1:
+                if monotonic() > deadline:
+                    break
+
+                sleep(self.retry_sleep)
+                continue
+
+            _, version, header_size, _, max_desktops, _, desktop_count, window_count, \
+                current_desktop, _ = HEADER_STRUCT.unpack_from(self.state_map, 0)
+
+            if version != STATE_VERSION:
+                raise GenericError("Unsupported state file version {}".format(version))
+
+            desktops = []
+
+            for desktop_index in range(desktop_count):
+                index, width, height, name = \
+                    DESKTOP_STRUCT.unpack_from(self.state_map,
+                                               header_size + (DESKTOP_STRUCT.size * desktop_index))
+
+                desktops.append({"index": index,
+                                 "width": width,
+                                 "height": height,
+                                 "name": name.rstrip(b"\0").decode("utf-8", "ignore")})
+
+            windows_offset = header_size + (DESKTOP_STRUCT.size * max_desktops)
+            windows = []
+
+            for window_index in range(window_count):
+                handle, desktop, pos_x, pos_y, size_x, size_y, win_type, title = \
+                    WINDOW_STRUCT.unpack_from(self.state_map,
+                                              windows_offset + (WINDOW_STRUCT.size * window_index))
+
+                windows.append({"handle": "0x{:08x}".format(handle),
+                                "desktop": desktop,
+                                "geometry": (pos_x, pos_y, size_x, size_y),
+                                "type": win_type.rstrip(b"\0").decode("utf-8", "ignore"),
+                                "title": title.rstrip(b"\0").decode("utf-8", "ignore")})
+
+            if self.get_generation() == generation:
+                return current_desktop, desktops, windows
+
+            if monotonic() > deadline:
+                break
+
+            sleep(self.retry_sleep)
+
+        raise GenericError("State file kept changing while being read")
+
+    def close(self):
+        self.state_map.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Print the window state published by workspaceorg')
+    parser.add_argument('state_file', help='Shared state file')
+
+    args = parser.parse_args()
+
+    reader = SharedStateReader(args.state_file)
+
+    current_desktop, desktops, windows = reader.read()
+
+    for desktop in desktops:
+        print("{} {} {}x{} {}".format(desktop["index"],
+                                      "*" if desktop["index"] == current_desktop else "-",
+                                      desktop["width"], desktop["height"], desktop["name"]))
+
+    for window in windows:
+        print("{} {} {} {} {} {} {} {}".format(window["handle"], window["desktop"],
+                                               *window["geometry"], window["type"],
+                                               window["title"]))
+
+    reader.close()
+
+if __name__ == "__main__":
+    exit(main())
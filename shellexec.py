@@ -0,0 +1,287 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+
+import os
+import selectors
+import signal
+from threading import BoundedSemaphore, Lock, local
+from time import monotonic
+
+class ExecResult:
+
+    """
+    Result of running a single command
+    """
+
+    def __init__(self, argv, returncode, stdout, stderr, duration, timed_out=False):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    def succeeded(self, expected_result=0):
+        return not self.timed_out and self.returncode == expected_result
+
+    def get_error(self):
+
+        """
+        Describe why a command failed, preferring its stderr over its stdout.
+        """
+
+        if self.timed_out:
+            return "timed out after {:.1f} secs".format(self.duration)
+
+        return "exit code {} : {}".format(self.returncode,
+                                          (self.stderr.strip() or self.stdout.strip()))
+
+    def __str__(self):
+        return "Command : {} | Exit code : {} | Duration : {:.3f} | Timed out : {}".format(" ".join(self.argv),
+                                                                                           self.returncode,
+                                                                                           self.duration,
+                                                                                           self.timed_out)
+
+
+class ExecStats:
+
+    """
+    Latency statistics for one command
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __str__(self):
+        return "{} : {} calls | Mean {:.1f} ms | Max {:.1f} ms | {} failed | {} timed out".format(self.name,
+                                                                                                 self.calls,
+                                                                                                 (self.total_time / max(self.calls, 1)) * 1000,
+                                                                                                 self.max_time * 1000,
+                                                                                                 self.failures,
+                                                                                                 self.timeouts)
+
+    def add(self, result, expected_result):
+        self.calls += 1
+        self.total_time += result.duration
+        self.max_time = max(self.max_time, result.duration)
+
+        if result.timed_out:
+            self.timeouts += 1
+        elif result.returncode != expected_result:
+            self.failures += 1
+
+
+class ShellExecutor:
+
+    """
+    Runs commands with posix_spawn (where available), with a timeout per call and a bound on
+    how many run at once. Output is read into per thread buffers that are reused from call to
+    call, and the latency of every call is recorded per command.
+    """
+
+    READ_SIZE = 65536
+
+    # How often to check whether the child has exited while its output pipes are still open,
+    # e.g. because it left a background process holding them.
+    EXIT_POLL_INTERVAL = 0.02
+
+    def __init__(self, max_concurrent=8, default_timeout=10.0):
+        self.default_timeout = default_timeout
+        self.max_concurrent = max_concurrent
+        self.semaphore = BoundedSemaphore(max_concurrent)
+        self.buffers = local()
+        self.stats = {}
+        self.stats_lock = Lock()
+
+    def configure(self, max_concurrent, default_timeout):
+
+        """
+        Change the concurrency bound and default timeout, before any commands are run.
+        """
+
+        self.default_timeout = default_timeout
+        self.max_concurrent = max_concurrent
+        self.semaphore = BoundedSemaphore(max_concurrent)
+
+    def get_buffers(self):
+
+        """
+        Get this thread's read buffer, and its stdout / stderr capture buffers, emptied.
+        """
+
+        if not hasattr(self.buffers, "read_buffer"):
+            self.buffers.read_buffer = bytearray(self.READ_SIZE)
+            self.buffers.stdout = bytearray()
+            self.buffers.stderr = bytearray()
+
+        self.buffers.stdout.clear()
+        self.buffers.stderr.clear()
+
+        return self.buffers.read_buffer, self.buffers.stdout, self.buffers.stderr
+
+    def run(self, argv, timeout=None, env=None, expected_result=0):
+
+        """
+        Run a command (as an argv list), returning an ExecResult. A timeout of None uses the
+        executor's default, a timeout of 0 waits forever.
+        """
+
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self.semaphore:
+            if hasattr(os, "posix_spawnp"):
+                result = self.run_spawn(argv, timeout, env)
+            else:
+                result = self.run_subprocess(argv, timeout, env)
+
+        name = os.path.basename(argv[0])
+
+        with self.stats_lock:
+            if name not in self.stats:
+                self.stats[name] = ExecStats(name)
+
+            self.stats[name].add(result, expected_result)
+
+        return result
+
+    def run_spawn(self, argv, timeout, env):
+
+        start_time = monotonic()
+
+        read_buffer, stdout, stderr = self.get_buffers()
+        read_view = memoryview(read_buffer)
+
+        # Pipes are created close on exec, only the dup'ed ends make it into the child.
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+
+        file_actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                        (os.POSIX_SPAWN_DUP2, stdout_write, 1),
+                        (os.POSIX_SPAWN_DUP2, stderr_write, 2)]
+
+        try:
+            pid = os.posix_spawnp(argv[0], argv, os.environ if env is None else env,
+                                  file_actions=file_actions)
+        except OSError as e:
+            for fd in (stdout_read, stdout_write, stderr_read, stderr_write):
+                os.close(fd)
+
+            return ExecResult(argv, 127, "", str(e), monotonic() - start_time)
+
+        os.close(stdout_write)
+        os.close(stderr_write)
+
+        timed_out = False
+        deadline = start_time + timeout if timeout else None
+        status = None
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(stdout_read, selectors.EVENT_READ, stdout)
+            selector.register(stderr_read, selectors.EVENT_READ, stderr)
+
+            # Read until the pipes close, or the child has exited and whatever it wrote has
+            # been read, as anything it left running may hold the pipes open indefinitely.
+            while selector.get_map():
+                if status is None:
+                    waited_pid, wait_status = os.waitpid(pid, os.WNOHANG)
+
+                    if waited_pid != 0:
+                        status = wait_status
+
+                if status is not None:
+                    wait_time = 0
+                else:
+                    wait_time = self.EXIT_POLL_INTERVAL
+
+                    if deadline is not None:
+                        remaining = deadline - monotonic()
+
+                        if remaining <= 0:
+                            timed_out = True
+                            break
+
+                        wait_time = min(wait_time, remaining)
+
+                events = selector.select(wait_time)
+
+                if not events and status is not None:
+                    break
+
+                for key, _ in events:
+                    read_count = os.readv(key.fd, [read_view])
+
+                    if read_count == 0:
+                        selector.unregister(key.fd)
+                    else:
+                        key.data.extend(read_view[:read_count])
+
+        os.close(stdout_read)
+        os.close(stderr_read)
+
+        if timed_out:
+            os.kill(pid, signal.SIGKILL)
+
+        if status is None:
+            _, status = os.waitpid(pid, 0)
+
+        return ExecResult(argv, os.waitstatus_to_exitcode(status),
+                          stdout.decode("utf-8", "replace"), stderr.decode("utf-8", "replace"),
+                          monotonic() - start_time, timed_out)
+
+    def run_subprocess(self, argv, timeout, env):
+
+        # Only a fallback, so not worth importing up front.
+        import subprocess
+
+        start_time = monotonic()
+
+        try:
+            process = subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, env=env, timeout=timeout or None)
+        except subprocess.TimeoutExpired as e:
+            return ExecResult(argv, -signal.SIGKILL, (e.stdout or b"").decode("utf-8", "replace"),
+                              (e.stderr or b"").decode("utf-8", "replace"),
+                              monotonic() - start_time, True)
+        except OSError as e:
+            return ExecResult(argv, 127, "", str(e), monotonic() - start_time)
+
+        return ExecResult(argv, process.returncode, process.stdout.decode("utf-8", "replace"),
+                          process.stderr.decode("utf-8", "replace"), monotonic() - start_time)
+
+    def get_stats(self):
+
+        """
+        Get a snapshot of the per command statistics, slowest total first.
+        """
+
+        with self.stats_lock:
+            return sorted(self.stats.values(), key=lambda stats: stats.total_time, reverse=True)
+
+
+shell_executor = ShellExecutor()
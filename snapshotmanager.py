@@ -0,0 +1,333 @@
+#   MIT License
+#
+#   Copyright (c) 2022 Paul Elliott
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in all
+#   copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#   SOFTWARE.
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from time import time
+
+from LoggerManager.loggermanager import Logger_Manager, Loglevel
+from utils import *
+from exceptions import *
+from configmanager import DEFAULT_TOLERANCE
+from shellexec import shell_executor
+from windowmanager import WindowFlag
+
+SNAPSHOT_VERSION = 1
+
+class SnapshotManager:
+
+    """
+    Save and restore the full window layout. Snapshots are JSON lines files, a header line
+    followed by one line per window. Incremental snapshots are appended to the same file and
+    only contain the windows that changed (or went away) since the last one, so loading
+    replays the file from the top.
+    """
+
+    def __init__(self, logger_manager, window_manager):
+        self.logger_manager = logger_manager
+        self.window_manager = window_manager
+
+        self.last_records = None
+        self.appended_records = 0
+
+    def get_window_record(self, win):
+
+        """
+        Get the snapshot record for a window, without its maximised state.
+        """
+
+        return {"handle": win.win_handle,
+                "type": win.win_type,
+                "description": win.description,
+                "desktop": win.desktop,
+                "geometry": [win.pos_x, win.pos_y, win.size_x, win.size_y]}
+
+    def get_current_records(self):
+
+        """
+        Get records for all current windows. Maximised state needs an extra query per window,
+        so it is only fetched for windows that changed since the last snapshot. A window that
+        can't be queried has closed since the window list was read, and is left out.
+        """
+
+        records = {}
+
+        for win_type in self.window_manager.win_dict:
+            for win in self.window_manager.win_dict[win_type]:
+
+                record = self.get_window_record(win)
+                last_record = self.last_records.get(win.win_handle)
+
+                if last_record is not None and \
+                    all(last_record[key] == record[key] for key in record):
+                    record["maximised"] = last_record["maximised"]
+                else:
+                    try:
+                        record["maximised"] = self.window_manager.get_window_state(win).value
+                    except GenericError as e:
+                        self.logger_manager.log(Loglevel.INFO,
+                                                "Leaving {} out of snapshot : {}".format(win.win_handle,
+                                                                                         e))
+                        continue
+
+                records[win.win_handle] = record
+
+        return records
+
+    def write_records(self, file, header, records):
+
+        file.write(json.dumps(header, separators=(",", ":")) + "\n")
+
+        for record in records:
+            file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def take_snapshot(self, snapshot_file, incremental=False):
+
+        """
+        Snapshot the current window state. An incremental snapshot is appended to an existing
+        file, and only records what changed. The file is rewritten in full once the
+        incremental records outgrow the layout itself.
+        """
+
+        if self.last_records is None:
+            if incremental and os.path.exists(snapshot_file):
+                self.last_records = self.load_snapshot(snapshot_file)
+            else:
+                self.last_records = {}
+                incremental = False
+
+        current_records = self.get_current_records()
+
+        if incremental and \
+            self.appended_records > max(len(current_records), 16) * 4:
+            incremental = False
+
+        if incremental:
+            changed = [record for handle, record in current_records.items()
+                       if self.last_records.get(handle) != record]
+
+            removed = [{"handle": handle, "removed": True} for handle in self.last_records
+                       if handle not in current_records]
+
+            if changed or removed:
+                header = {"version": SNAPSHOT_VERSION,
+                          "kind": "incremental",
+                          "time": time(),
+                          "count": len(changed) + len(removed)}
+
+                with open(snapshot_file, "a") as file:
+                    self.write_records(file, header, changed + removed)
+
+                self.appended_records += len(changed) + len(removed)
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "Incremental snapshot : {} changed, {} removed".format(len(changed),
+                                                                                           len(removed)))
+        else:
+            header = {"version": SNAPSHOT_VERSION,
+                      "kind": "full",
+                      "time": time(),
+                      "count": len(current_records)}
+
+            # Write to a temporary file first, so a crash never leaves a truncated snapshot.
+            temp_file = "{}.tmp".format(snapshot_file)
+
+            with open(temp_file, "w") as file:
+                self.write_records(file, header, current_records.values())
+
+            os.replace(temp_file, snapshot_file)
+            self.appended_records = 0
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "Full snapshot : {} windows".format(len(current_records)))
+
+        self.last_records = current_records
+
+    def load_snapshot(self, snapshot_file):
+
+        """
+        Load a snapshot file, replaying any incremental snapshots, returns a dictionary of
+        window records keyed by window handle.
+        """
+
+        records = {}
+        remaining = 0
+
+        with open(snapshot_file) as file:
+            for line_number, line in enumerate(file, start = 1):
+
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise GenericError("Corrupt snapshot {} at line {}".format(snapshot_file,
+                                                                               line_number))
+
+                if remaining == 0:
+                    if entry.get("version") != SNAPSHOT_VERSION:
+                        raise GenericError("Unsupported snapshot version {} in {}".format(entry.get("version"),
+                                                                                          snapshot_file))
+                    if entry.get("kind") == "full":
+                        records = {}
+
+                    remaining = entry.get("count", 0)
+
+                elif entry.get("removed", False):
+                    records.pop(entry["handle"], None)
+                    remaining -= 1
+
+                else:
+                    records[entry["handle"]] = entry
+                    remaining -= 1
+
+        # A crash part way through appending leaves a short final snapshot, which is still
+        # usable as far as it goes.
+        if remaining != 0:
+            self.logger_manager.log(Loglevel.INFO,
+                                    "Snapshot {} truncated, {} records missing".format(snapshot_file,
+                                                                                       remaining))
+
+        return records
+
+    def match_records(self, records):
+
+        """
+        Pair current windows with snapshot records. Windows are matched on handle first (same
+        session), then on type and description, then on type alone, each record being used
+        at most once.
+        """
+
+        matches = []
+        unmatched = []
+        unused = dict(records)
+
+        for win_type in self.window_manager.win_dict:
+            for win in self.window_manager.win_dict[win_type]:
+                if win.win_handle in unused:
+                    matches.append((win, unused.pop(win.win_handle)))
+                else:
+                    unmatched.append(win)
+
+        for exact in (True, False):
+            still_unmatched = []
+
+            for win in unmatched:
+                record = next((record for record in unused.values()
+                               if record["type"] == win.win_type and
+                               (not exact or record["description"] == win.description)), None)
+
+                if record is None:
+                    still_unmatched.append(win)
+                else:
+                    matches.append((win, unused.pop(record["handle"])))
+
+            unmatched = still_unmatched
+
+        return matches
+
+    def restore_snapshot(self, snapshot_file):
+
+        """
+        Restore a layout from a snapshot. The whole layout is worked out before anything is
+        moved, then applied in a single batch, with windows restored concurrently (as far as
+        the shell executor allows), skipping windows that are already in place to within the
+        config's tolerance.
+        """
+
+        records = self.load_snapshot(snapshot_file)
+        config = self.window_manager.config_manager.get_active_config()
+        tolerance = config.tolerance if config is not None else DEFAULT_TOLERANCE
+        operations = []
+
+        for win, record in self.match_records(records):
+
+            geometry = tuple(record["geometry"])
+            flags = WindowFlag(record["maximised"])
+
+            if record["desktop"] not in self.window_manager.desktops and record["desktop"] != -1:
+                self.logger_manager.log(Loglevel.INFO,
+                                        "Not restoring {}, desktop {} not present".format(win.win_handle,
+                                                                                          record["desktop"]))
+                continue
+
+            needs_move = win.desktop != record["desktop"]
+            needs_resize = not self.window_manager.geometry_settled(win, geometry, tolerance)
+
+            if needs_move or needs_resize or flags != WindowFlag.NONE:
+                operations.append((win, record["desktop"], geometry, flags, needs_move,
+                                   needs_resize))
+
+        restored = 0
+
+        if operations:
+            with ThreadPoolExecutor(max_workers=min(len(operations),
+                                                    shell_executor.max_concurrent)) as executor:
+                restored = sum(executor.map(lambda operation: self.restore_window(*operation),
+                                            operations))
+
+        self.logger_manager.log(Loglevel.INFO,
+                                "Restored {} of {} windows from {}".format(restored,
+                                                                           len(records),
+                                                                           snapshot_file))
+
+    def restore_window(self, win, desktop, geometry, flags, needs_move, needs_resize):
+
+        """
+        Restore a single window from its snapshot record, returns True if anything had to
+        be changed.
+        """
+
+        # Moving or resizing demaximises, otherwise only re-send flags the window lacks.
+        if flags != WindowFlag.NONE and not (needs_move or needs_resize):
+            try:
+                if (self.window_manager.get_window_state(win) & flags) == flags:
+                    return False
+            except GenericError as e:
+                self.logger_manager.log(Loglevel.INFO,
+                                        "Not restoring {} : {}".format(win.win_handle, e))
+                return False
+
+        if needs_move or needs_resize:
+            self.window_manager.demaximise_window(win)
+
+        if needs_move:
+            result = exec_result("wmctrl -i -r {} -t {}".format(win.win_handle,
+                                                                desktop),
+                                 display=self.window_manager.display)
+            if not result.succeeded():
+                raise GenericError("Moving {} to {} failed : {}".format(win.win_handle,
+                                                                        desktop,
+                                                                        result.get_error()))
+            win.desktop = desktop
+
+        if needs_resize:
+            result = exec_result("wmctrl -i -r {} -e 0,{},{},{},{}".format(win.win_handle,
+                                                                           *geometry),
+                                 display=self.window_manager.display)
+            if not result.succeeded():
+                raise GenericError("Restoring {} geometry failed : {}".format(win.win_handle,
+                                                                             result.get_error()))
+
+        if flags != WindowFlag.NONE:
+            self.window_manager.set_window_state(win, flags)
+
+        return True
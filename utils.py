@@ -20,27 +20,35 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #   SOFTWARE.
 
-from subprocess import Popen, PIPE
 from shlex import split
+import os
+import sys
 
-def do_shell_exec(exec_string, expected_result = 0):
+from shellexec import shell_executor
+from LoggerManager.loggermanager import Loglevel
+
+class NullLogger:
 
     """
-    Helper function to do shell executions
+    Stand in for the logger manager when no logging was asked for, which still reports
+    warnings and errors on stderr rather than losing them.
     """
 
-    shell_process = Popen(split(exec_string), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    def log(self, level, message):
+        if level in (Loglevel.WARNING, Loglevel.ERROR):
+            print(message, file=sys.stderr)
+
+def exec_result(exec_string, expected_result = 0, display = None, timeout = None):
 
-    (shell_stdout, shell_stderr) = shell_process.communicate()
+    """
+    Helper function to do shell executions, optionally against a specific X display. A
+    timeout of None uses the shell executor's default, 0 waits forever. Returns the full
+    ExecResult (exit code, stdout, stderr and duration).
+    """
 
-    if shell_process.returncode != expected_result:
-        self.logger_manager.log(Loglevel.INFO,
-                                "{} returned {}".format(exec_string,
-                                                        shell_process.returncode))
-        logger_manager.log(Loglevel.INFO,
-                           "stderr: {}".format(shell_stderr.decode("UTF-8")))
-        return False, shell_stdout.decode("utf-8")
+    env = None
 
-    else:
-        return True, shell_stdout.decode("utf-8")
+    if display != None:
+        env = dict(os.environ, DISPLAY=display)
 
+    return shell_executor.run(split(exec_string), timeout, env, expected_result)
@@ -20,11 +20,16 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #   SOFTWARE.
 
-from enum import Flag, auto
-import toml
+from enum import Enum, Flag, auto
+from fnmatch import translate
+import os
+import re
 from LoggerManager.loggermanager import Logger_Manager, Loglevel
 from utils import *
 from exceptions import *
+from matchcache import MatchCache
+from processindex import ProcessIndex
+from time import perf_counter, time
 
 class Window:
 
@@ -32,7 +37,8 @@ class Window:
     Class describing an XWindow existing in the current X11 session
     """
 
-    def __init__(self, win_handle, desktop, pos_x, pos_y, size_x, size_y, win_type, description):
+    def __init__(self, win_handle, desktop, pos_x, pos_y, size_x, size_y, win_type, description,
+                 pid=0, client_machine=""):
         self.win_handle = win_handle
         self.desktop = int(desktop)
         self.pos_x = int(pos_x)
@@ -41,8 +47,15 @@ class Window:
         self.size_y = int(size_y)
         self.win_type = win_type
         self.description = description
+        self.pid = int(pid)
+        self.client_machine = client_machine
+        self.process = None
+        self.process_resolved = False
+        self.new = True
+        self.deferrals = 0
         self.seen = True
         self.rule_applied = False
+        self.reset_enforcement(None)
 
     def __str__(self):
         return "Handle : {} | Workspace : {} | Type : {} | Pos {} x {} | Size {} x {} | Desc : {}".format(self.win_handle,
@@ -54,6 +67,18 @@ class Window:
                                                                                                           self.size_y,
                                                                                                           self.description)
 
+    def reset_enforcement(self, rule_name):
+
+        """
+        Reset rule enforcement state, e.g. because a different rule now applies.
+        """
+
+        self.rule_name = rule_name
+        self.corrections = 0
+        self.backoff_until = 0
+        self.placed = False
+        self.flags_applied = False
+
     def update(self, desktop, pos_x, pos_y, size_x, size_y, description):
 
         """
@@ -66,20 +91,20 @@ class Window:
             self.desktop = int(desktop)
             changed = True
 
-        if self.pos_x != pos_x:
-            self.pos_x = pos_x
+        if self.pos_x != int(pos_x):
+            self.pos_x = int(pos_x)
             changed = True
 
-        if self.pos_y != pos_y:
-            self.pos_y = pos_y
+        if self.pos_y != int(pos_y):
+            self.pos_y = int(pos_y)
             changed = True
 
-        if self.size_x != size_x:
-            self.size_x = size_x
+        if self.size_x != int(size_x):
+            self.size_x = int(size_x)
             changed = True
 
-        if self.size_y != size_y:
-            self.size_y = size_y
+        if self.size_y != int(size_y):
+            self.size_y = int(size_y)
             changed = True
 
         if self.description != description:
@@ -98,6 +123,53 @@ class WindowFlag(Flag):
     MAXIMISED = MAX_HORIZONTAL | MAX_VERTICAL
 
 
+class MatchType(Enum):
+    SUBSTRING = auto()
+    EXACT = auto()
+    GLOB = auto()
+    REGEX = auto()
+
+
+class LayoutType(Enum):
+    GRID = "grid"
+    COLUMNS = "columns"
+    MASTER_STACK = "master-stack"
+
+
+class MatchPredicate:
+
+    """
+    A single window attribute match, with any pattern compiled up front. Raises re.error if
+    a regex pattern is invalid.
+    """
+
+    def __init__(self, pattern, match_type=MatchType.SUBSTRING):
+        self.pattern = pattern
+        self.match_type = match_type
+        self.regex = None
+
+        if match_type == MatchType.GLOB:
+            self.regex = re.compile(translate(pattern))
+        elif match_type == MatchType.REGEX:
+            self.regex = re.compile(pattern)
+
+    def __str__(self):
+        return "{} {}".format(self.match_type.name.lower(), self.pattern)
+
+    def matches(self, value):
+
+        if self.match_type == MatchType.SUBSTRING:
+            return self.pattern in value
+
+        if self.match_type == MatchType.EXACT:
+            return self.pattern == value
+
+        if self.match_type == MatchType.GLOB:
+            return self.regex.match(value) is not None
+
+        return self.regex.search(value) is not None
+
+
 class WindowRule:
 
     """
@@ -106,20 +178,88 @@ class WindowRule:
 
     def __init__(self, name, desktop, pos_x, pos_y, size_x, size_y, flags):
         self.name = name
+        self.order = -1
         self.win_type = ""
         self.description = ""
+        self.type_predicate = None
+        self.description_predicate = None
+        self.exe_predicate = None
+        self.cmdline_predicate = None
+        self.cgroup_predicate = None
         self.desktop = desktop
+        self.desktop_name = None
         self.pos_x = pos_x
         self.pos_y = pos_y
         self.size_x = size_x
         self.size_y = size_y
         self.flags = flags
+        self.place_once = False
+        self.layout = None
+        self.layout_gap = 0
+        self.layout_master_ratio = 0.5
+        self.layout_monitor = ""
+
+    def set_place_once(self, place_once):
+        self.place_once = place_once
+
+    def set_layout(self, layout, gap, master_ratio, monitor):
+        self.layout = layout
+        self.layout_gap = gap
+        self.layout_master_ratio = master_ratio
+        self.layout_monitor = monitor
+
+    def set_win_type(self, type_predicate):
+        self.win_type = type_predicate.pattern
+        self.type_predicate = type_predicate
+
+    def set_win_description(self, description_predicate):
+        self.description = description_predicate.pattern
+        self.description_predicate = description_predicate
+
+    def set_desktop_name(self, desktop_name):
+        self.desktop_name = desktop_name
+
+    def set_process_predicates(self, exe_predicate, cmdline_predicate, cgroup_predicate):
+        self.exe_predicate = exe_predicate
+        self.cmdline_predicate = cmdline_predicate
+        self.cgroup_predicate = cgroup_predicate
+
+    def needs_process(self):
 
-    def set_win_type(self, win_type):
-        self.win_type = win_type;
+        """
+        Check whether this rule matches on the window's owning process.
+        """
+
+        return self.exe_predicate is not None or self.cmdline_predicate is not None or \
+            self.cgroup_predicate is not None
+
+    def matches(self, win_type, description, process=None):
+
+        """
+        Check whether a window of the given type and description (and owning process, if
+        known) matches this rule.
+        """
+
+        if self.type_predicate is not None and not self.type_predicate.matches(win_type):
+            return False
 
-    def set_win_description(self, win_description):
-        self.description = win_description
+        if self.description_predicate is not None and \
+            not self.description_predicate.matches(description):
+            return False
+
+        if not self.needs_process():
+            return True
+
+        if process is None:
+            return False
+
+        for predicate, value in ((self.exe_predicate, process.exe),
+                                 (self.cmdline_predicate, process.cmdline),
+                                 (self.cgroup_predicate, process.cgroup)):
+            if predicate is not None and not predicate.matches(value):
+                return False
+
+        return True
 
 
 class Desktop:
@@ -146,15 +286,35 @@ class Desktop:
 class WindowManager:
 
 
-    def __init__(self, logger_manager):
+    def __init__(self, logger_manager, display=None):
+        self.display = display
         self.win_dict = {}
         self.desktops = {}
+        self.desktop_names = {}
+        self.desktop_fingerprint = None
+        self.current_desktop = -1
         self.logger_manager = logger_manager
         self.config_manager = None
+        self.match_cache = MatchCache()
+        self.match_cache_config = None
+        self.apply_pass = 0
+        self.deferred_windows = 0
+        self.process_index = ProcessIndex()
+        self.placement_store = None
+        self.first_placement_time = None
+        self.hardware_manager = None
+        self.layout_cache = {}
+        self.hostname = os.uname().nodename
 
     def set_config_manager(self, config_manager):
         self.config_manager = config_manager
 
+    def set_placement_store(self, placement_store):
+        self.placement_store = placement_store
+
+    def set_hardware_manager(self, hardware_manager):
+        self.hardware_manager = hardware_manager
+
     def print(self):
         """
         Debug printing of Window Manager contents
@@ -175,7 +335,7 @@ class WindowManager:
         return False
 
     def add_or_update_window(self, win_handle, desktop, pos_x, pos_y, size_x, size_y, win_type,
-                             description):
+                             description, pid=0, client_machine=""):
 
         """
         Add details for a new window, or update one we already knew about.
@@ -196,40 +356,104 @@ class WindowManager:
                                                                                win_type, description))
                 self.win_dict[win_type].append(Window(win_handle, desktop, pos_x, pos_y,
                                                        size_x, size_y,
-                                                       win_type, description))
+                                                       win_type, description,
+                                                       pid, client_machine))
         else:
             self.win_dict[win_type] = []
             self.win_dict[win_type].append(Window(win_handle, desktop, pos_x, pos_y, size_x,
-                                                   size_y, win_type, description))
+                                                   size_y, win_type, description, pid,
+                                                   client_machine))
 
     def get_desktop_details(self):
 
         """
-        Get all currently configured desktops details.
+        Get all currently configured desktops details. The desktop table is only rebuilt if the
+        topology (indices, sizes or names) has changed since the last call, returns True if it
+        was.
         """
-        success, output = do_shell_exec("wmctrl -d")
+        result = exec_result("wmctrl -d", display=self.display)
+
+        if not result.succeeded():
+            raise GenericError("wmctrl -d failed : {}".format(result.get_error()))
 
-        if not success:
-            raise GenericError("wmctrl -d returned {}".format(output))
+        desktop_details = []
 
-        for line in output.splitlines():
+        for line in result.stdout.splitlines():
             line_split = line.split()
 
-            desktop_index = int(line_split[0])
-            new_desktop = Desktop(desktop_index, line_split[3], line_split[len(line_split) - 1])
+            if line_split[1] == "*":
+                self.current_desktop = int(line_split[0])
+
+            desktop_details.append((int(line_split[0]), line_split[3],
+                                    line_split[len(line_split) - 1]))
+
+        # The current desktop marker is deliberately not part of the fingerprint, switching
+        # desktops is not a topology change.
+        fingerprint = hash(tuple(desktop_details))
+
+        if fingerprint == self.desktop_fingerprint:
+            return False
+
+        self.desktop_fingerprint = fingerprint
+        self.desktops = {}
+        self.desktop_names = {}
+
+        for desktop_index, desktop_size, desktop_name in desktop_details:
+            new_desktop = Desktop(desktop_index, desktop_size, desktop_name)
             self.desktops[desktop_index] = new_desktop;
 
+            # First desktop with a given name wins, as with the old linear lookup.
+            self.desktop_names.setdefault(desktop_name, desktop_index)
+
+        return True
+
+    def refresh_desktops(self):
+
+        """
+        Re-read the desktop topology, and if it has changed, re-resolve any rules that refer to
+        desktops by name.
+        """
+
+        if self.get_desktop_details():
+            self.logger_manager.log(Loglevel.INFO, "Desktop topology changed")
+            self.resolve_rule_desktops()
+
+    def resolve_rule_desktops(self):
+
+        """
+        Update the desktop index of rules that refer to a desktop by name. Only rules whose
+        desktop has actually moved are touched, rules for desktops that no longer exist are
+        disabled until it reappears.
+        """
+
+        if self.config_manager is None:
+            return
+
+        config = self.config_manager.get_active_config()
+
+        if config is None:
+            return
+
+        for rule in config.win_rules:
+            if rule.desktop_name is None:
+                continue
+
+            desktop_index = self.get_desktop_index(rule.desktop_name)
+
+            if desktop_index != rule.desktop:
+                self.logger_manager.log(Loglevel.INFO,
+                                        "Rule {} desktop {} now {}".format(rule.name,
+                                                                           rule.desktop_name,
+                                                                           desktop_index))
+                rule.desktop = desktop_index
+
     def get_desktop_index(self, desktop_name):
 
         """
         Get a desktop's index from its name, returns -1 if not found.
         """
 
-        for desktop_index, desktop in self.desktops.items():
-            if desktop.name == desktop_name:
-                return desktop_index
-
-        return -1
+        return self.desktop_names.get(desktop_name, -1)
 
     def get_window_details(self):
 
@@ -241,30 +465,50 @@ class WindowManager:
                 win.seen = False
                 win.rule_applied = False
 
-        success, output = do_shell_exec("wmctrl -lxG")
+        # -p gets us the owning pid (_NET_WM_PID, 0 if the window does not set it) for free.
+        result = exec_result("wmctrl -lpxG", display=self.display)
 
-        if not success:
-            raise GenericError("wmctrl -lxG returned {}".format(output))
+        if not result.succeeded():
+            raise GenericError("wmctrl -lpxG failed : {}".format(result.get_error()))
 
-        for line in output.splitlines():
-            line_split = line.split(maxsplit=8)
+        for line in result.stdout.splitlines():
+            line_split = line.split(maxsplit=9)
 
             # Dialogs do not have titles / descriptions
             win_title = ""
-            if len(line_split) > 8:
-                win_title = line_split[8]
+            if len(line_split) > 9:
+                win_title = line_split[9]
 
-            self.add_or_update_window(line_split[0], line_split[1], line_split[2],
-                                      line_split[3], line_split[4], line_split[5], line_split[6],
-                                      win_title)
+            self.add_or_update_window(line_split[0], line_split[1], line_split[3],
+                                      line_split[4], line_split[5], line_split[6], line_split[7],
+                                      win_title, line_split[2], line_split[8])
 
         # remove any windows that have disappeared since last update
         for win_type in self.win_dict:
-            for win_count, win in enumerate(self.win_dict[win_type]):
+            for win in self.win_dict[win_type]:
                 if not win.seen:
                     self.logger_manager.log(Loglevel.DEBUG,
                                             "removing {} as not found".format(win.win_handle))
-                    self.win_dict[win_type].pop(win_count)
+
+            self.win_dict[win_type] = [win for win in self.win_dict[win_type] if win.seen]
+
+        self.process_index.prune({win.pid for win_type in self.win_dict
+                                  for win in self.win_dict[win_type]})
+
+    def get_window_process(self, win):
+
+        """
+        Get the details of the process owning a window, or None if unknown. This is only
+        looked up once per window, and only for windows from this machine.
+        """
+
+        if not win.process_resolved:
+            win.process_resolved = True
+
+            if win.pid > 0 and win.client_machine == self.hostname:
+                win.process = self.process_index.get_process(win.pid)
+
+        return win.process
 
     def dump_window_details(self, dump_file):
 
@@ -301,10 +545,39 @@ class WindowManager:
 
         out_dict["Apps"] = apps_dict
 
+        # Only needed here, so not worth importing on every startup.
+        import toml
+
         with open(dump_file, "w") as file:
             toml.dump(out_dict, file)
 
 
+    def find_rule(self, config, win):
+
+        """
+        Find the first rule (in config order) that matches a window, or None. Results are
+        cached by window type and description, plus the owning process if any rule needs it.
+        """
+
+        process = None
+        process_key = None
+
+        if config.needs_process:
+            process = self.get_window_process(win)
+
+            if process is not None:
+                process_key = (process.pid, process.start_time)
+
+        cache_key = (win.win_type, win.description, process_key)
+
+        found, rule = self.match_cache.lookup(cache_key)
+
+        if not found:
+            rule = config.find_rule(win.win_type, win.description, process)
+            self.match_cache.store(cache_key, rule)
+
+        return rule
+
     def apply_rules(self):
 
         """
@@ -313,140 +586,491 @@ class WindowManager:
 
         config = self.config_manager.get_active_config()
 
-        for rule in config.win_rules:
-            for win_type in self.win_dict:
-                if win_type.find(rule.win_type) != -1:
-                    self.logger_manager.log(Loglevel.INFO, "found {}".format(rule.win_type))
-
-                    for win in self.win_dict[win_type]:
-
-                        if not win.rule_applied:
-
-                            if rule.description == "" or rule.description in win.description:
-
-                                win_demaximised = False
-                                win.rule_applied = True
-
-                                if win.desktop != rule.desktop:
-                                    self.logger_manager.log(Loglevel.DEBUG,
-                                                            "moving {} to {}".format(rule.win_type,
-                                                                                     rule.desktop))
-
-                                    if config.demaximise:
-                                        # Some DE's will fail to move a window if its maximised, so remove these flags.
-                                        success, \
-                                            output = do_shell_exec("wmctrl -i -r {} -b remove,maximized_vert,maximized_horz".format(win.win_handle,
-                                                                                                                                         rule.desktop))
-                                        if success:
-                                            win_demaximised = True
-                                        else:
-                                            raise GenericError("De-maximising {} failed : %s".format(win.win_handle,
-                                                                                                     output))
-
-                                    success, \
-                                        output = do_shell_exec("wmctrl -i -r {} -t {}".format(win.win_handle,
-                                                                                                   rule.desktop))
-
-                                    if not success:
-                                        raise GenericError("Moving {} to {} failed : {}".format(win.win_handle,
-                                                                                                rule.desktop,
-                                                                                                output))
-
-                                    win.desktop = rule.desktop
-
-                                else:
-                                    self.logger_manager.log(Loglevel.DEBUG,
-                                                            "{} already on {}".format(rule.win_type,
-                                                                                      win.desktop))
-
-
-
-                                # Get desktop to work out absolute sizes (if required)
-                                desktop_width = self.desktops[win.desktop].width
-                                desktop_height = self.desktops[win.desktop].height
-
-                                if type(rule.pos_x) == float:
-                                    if rule.pos_x >= 0.0:
-                                        pos_x = int(desktop_width * rule.pos_x) + 4
-                                    else:
-                                        pos_x = -1
-                                else:
-                                    pos_x = rule.pos_x
-
-                                if type(rule.pos_y) == float:
-                                    if rule.pos_y >= 0.0:
-                                        pos_y = int(desktop_height * rule.pos_y) + 4
-                                    else:
-                                        pos_y = -1
-                                else:
-                                    pos_y = rule.pos_y
-
-                                if type(rule.size_x) == float:
-                                    if rule.size_x >= 0.0:
-                                        size_x = int(desktop_width * rule.size_x) - 8
-                                    else:
-                                        size_x = -1
-                                else:
-                                    size_x = rule.size_x
-
-                                if type(rule.size_y) == float:
-                                    if rule.size_y >= 0.0:
-                                        size_y = int(desktop_height * rule.size_y) - 8
-                                    else:
-                                        size_y = -1
-                                else:
-                                    size_y = rule.size_y
-
-                                if pos_x != -1 or pos_y != -1 or \
-                                    size_x != -1 or size_y != -1:
-                                    if win.pos_x != pos_x or win.pos_y != pos_y or win.size_x \
-                                        != size_x or win.size_y != size_y:
-
-
-                                        self.logger_manager.log(Loglevel.INFO,
-                                                                "moving {} to ({}x{}) - size ({}x{})".format(rule.win_type,
-                                                                                                             pos_x,
-                                                                                                             pos_y,
-                                                                                                             size_x,
-                                                                                                             size_y))
-
-                                        if config.demaximise and not win_demaximised:
-                                            # Some DE's will fail to move a window if its maximised, so remove these flags, if we didn't
-                                            # already do this earlier
-                                            success, \
-                                                output = do_shell_exec("wmctrl -i -r {} -b remove,maximized_vert,maximized_horz".format(win.win_handle,
-                                                                                                                                             rule.desktop))
-                                            if not success:
-                                                raise GenericError("De-maximising {} failed : %s".format(win.win_handle,
-                                                                                                         output))
-
-                                        success, \
-                                            output = do_shell_exec("wmctrl -i -r {} -e 0,{},{},{},{}".format(win.win_handle,
-                                                                                                                  pos_x,
-                                                                                                                  pos_y,
-                                                                                                                  size_x,
-                                                                                                                  size_y))
-
-                                        if not success:
-                                            raise GenericError("moving {} to ({}x{}) - size ({}x{}) failed : {}".format(rule.win_type,
-                                                                                                                        pos_x,
-                                                                                                                        pos_y,
-                                                                                                                        size_x,
-                                                                                                                        size_y,
-                                                                                                                        output))
-                                if rule.flags & WindowFlag.MAXIMISED:
-
-                                    add_flags = ""
-                                    if rule.flags & WindowFlag.MAX_VERTICAL:
-                                        add_flags += ",maximized_vert"
-
-                                    if rule.flags & WindowFlag.MAX_HORIZONTAL:
-                                        add_flags += ",maximized_horiz"
-
-                                    success, \
-                                        output = do_shell_exec("wmctrl -i -r {} -b add{}".format(win.win_handle,
-                                                                                                      add_flags))
-                                    if not success:
-                                        raise GenericError("Maximising {} failed : %s".format(win.win_handle,
-                                                                                              output))
+        self.apply_pass += 1
+
+        if config is not self.match_cache_config:
+            self.match_cache = MatchCache(config.match_cache_size)
+            self.match_cache_config = config
+            self.layout_cache = {}
+
+        pass_start = time()
+        pending = []
+        self.deferred_windows = 0
+
+        for win_type in self.win_dict:
+            for win in self.win_dict[win_type]:
+
+                if win.rule_applied:
+                    continue
+
+                rule = self.find_rule(config, win)
+
+                if rule is None:
+                    win.new = False
+                    continue
+
+                pending.append((win, rule))
+
+        layout_geometries = self.get_layout_geometries(pending)
+
+        # Order only matters if the budget may defer some of the windows that need work, and
+        # focus only separates windows that are neither new nor on the current desktop, so
+        # only ask which window has focus if it could change what happens this pass.
+        active_type = None
+
+        if config.loop_budget > 0:
+            working = [win for win, rule in pending
+                       if self.window_needs_work(config, rule, win,
+                                                 layout_geometries.get(win.win_handle))]
+
+            if len(working) > 1 and any(not win.new and win.desktop != self.current_desktop
+                                        for win in working):
+                active_type = self.get_active_window_type()
+
+        pending.sort(key=lambda item: self.get_window_priority(item[0], active_type))
+
+        for pending_count, (win, rule) in enumerate(pending):
+
+            # Always make some progress, however tight the budget.
+            if pending_count > 0 and config.loop_budget > 0 and \
+                time() - pass_start > config.loop_budget:
+                for deferred_win, _ in pending[pending_count:]:
+                    deferred_win.deferrals += 1
+
+                self.deferred_windows = len(pending) - pending_count
+
+                self.logger_manager.log(Loglevel.INFO,
+                                        "Loop budget used, deferring {} windows".format(self.deferred_windows))
+                break
+
+            win.new = False
+            win.deferrals = 0
+
+            if rule.desktop not in self.desktops:
+                self.logger_manager.log(Loglevel.DEBUG,
+                                        "Skipping rule {}, desktop {} not present".format(rule.name,
+                                                                                          rule.desktop))
+                continue
+
+            self.logger_manager.log(Loglevel.INFO, "found {}".format(rule.win_type))
+
+            self.apply_rule(config, rule, win, layout_geometries.get(win.win_handle))
+
+        self.logger_manager.log(Loglevel.INFO, "Match cache : {}".format(self.match_cache))
+
+    def get_layout_region(self, rule):
+
+        """
+        Get the area (x, y, width, height) a layout rule tiles over, its monitor if it names
+        one, otherwise the whole desktop.
+        """
+
+        desktop = self.desktops[rule.desktop]
+
+        if rule.layout_monitor:
+            monitor = None
+
+            if self.hardware_manager is not None:
+                monitor = self.hardware_manager.monitors.get(rule.layout_monitor)
+
+            if monitor is not None:
+                return (monitor.offset_x, monitor.offset_y, monitor.size_x, monitor.size_y)
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "Monitor {} in rule {} not found, using whole desktop".format(rule.layout_monitor,
+                                                                                                  rule.name))
+
+        return (0, 0, desktop.width, desktop.height)
+
+    def get_layout_geometries(self, pending):
+
+        """
+        Work out the geometry of every window matched by a layout rule, returns a dictionary
+        of geometry keyed by window handle. Each rule's layout is solved for all its windows
+        at once, and only re-solved when the windows it covers (or the area it tiles) change.
+        """
+
+        layout_members = {}
+
+        for win, rule in pending:
+            if rule.layout is not None and rule.desktop in self.desktops:
+                layout_members.setdefault(rule.name, (rule, []))[1].append(win.win_handle)
+
+        if not layout_members:
+            return {}
+
+        from layoutengine import solve_layout
+
+        geometries = {}
+
+        for rule_name, (rule, win_handles) in layout_members.items():
+
+            # Keep windows in a stable order, so they don't swap places between passes.
+            win_handles = tuple(sorted(win_handles, key=lambda handle: int(handle, 16)))
+            region = self.get_layout_region(rule)
+            layout_key = (rule, rule.desktop, region, win_handles)
+
+            cached_layout = self.layout_cache.get(rule_name)
+
+            if cached_layout is None or cached_layout[0] != layout_key:
+                self.logger_manager.log(Loglevel.INFO,
+                                        "Laying out {} windows for {}".format(len(win_handles),
+                                                                              rule_name))
+
+                layout = solve_layout(rule.layout, len(win_handles), region, rule.layout_gap,
+                                      rule.layout_master_ratio)
+
+                cached_layout = (layout_key,
+                                 dict(zip(win_handles, (tuple(row) for row in layout.tolist()))))
+                self.layout_cache[rule_name] = cached_layout
+
+            geometries.update(cached_layout[1])
+
+        return geometries
+
+    def get_active_window_type(self):
+
+        """
+        Get the type of the currently focused window, or None if there isn't one (or we can't
+        tell).
+        """
+
+        result = exec_result("xprop -root _NET_ACTIVE_WINDOW", display=self.display)
+
+        if not result.succeeded():
+            self.logger_manager.log(Loglevel.INFO,
+                                    "xprop -root _NET_ACTIVE_WINDOW failed : {}".format(result.get_error()))
+            return None
+
+        try:
+            active_handle = int(result.stdout.split()[-1], 16)
+        except (IndexError, ValueError):
+            return None
+
+        for win_type in self.win_dict:
+            for win in self.win_dict[win_type]:
+                if int(win.win_handle, 16) == active_handle:
+                    return win_type
+
+        return None
+
+    def window_needs_work(self, config, rule, win, geometry=None):
+
+        """
+        Check whether applying a rule to a window would do anything this pass, i.e. move,
+        resize or set flags on it. Windows that are settled, backed off, or placed once
+        already need nothing.
+        """
+
+        if rule.desktop not in self.desktops:
+            return False
+
+        if win.rule_name != rule.name:
+            return True
+
+        if (rule.place_once and win.placed) or self.apply_pass < win.backoff_until:
+            return False
+
+        if geometry is None:
+            geometry = self.get_rule_geometry(rule, rule.desktop)
+
+        return win.desktop != rule.desktop or \
+            not self.geometry_settled(win, geometry, config.tolerance) or \
+            (not win.flags_applied and bool(rule.flags & WindowFlag.MAXIMISED))
+
+    def get_window_priority(self, win, active_type):
+
+        """
+        Get a sort key for applying rules to a window, lowest first. Newly mapped windows come
+        first, then windows on the current desktop, then windows of the same type as the
+        focused one, then everything else. Windows deferred by the loop budget age towards the
+        front, so nothing is starved.
+        """
+
+        if win.new:
+            tier = 0
+        elif win.desktop == self.current_desktop:
+            tier = 1
+        elif win.win_type == active_type:
+            tier = 2
+        else:
+            tier = 3
+
+        return max(tier - win.deferrals, 0), tier
+
+    def recall_placement(self, config, rule, win):
+
+        """
+        If a window is already where it was left last time this rule applied to it, treat
+        the rule as applied already, rather than sending its flags again.
+        """
+
+        if self.placement_store is None or rule.layout is not None:
+            return
+
+        entry = self.placement_store.lookup(win.win_type, rule.name)
+
+        if entry is None or entry["desktop"] != win.desktop:
+            return
+
+        if self.geometry_settled(win, entry["geometry"], config.tolerance):
+            self.logger_manager.log(Loglevel.DEBUG,
+                                    "{} already placed by {}".format(win.win_handle, rule.name))
+            win.placed = True
+            win.flags_applied = True
+
+    def get_rule_geometry(self, rule, desktop):
+
+        """
+        Work out the absolute position and size a rule asks for on a given desktop, as a
+        (pos_x, pos_y, size_x, size_y) tuple. Anything the rule does not specify is -1.
+        """
+
+        # Get desktop to work out absolute sizes (if required)
+        desktop_width = self.desktops[desktop].width
+        desktop_height = self.desktops[desktop].height
+
+        if type(rule.pos_x) == float:
+            if rule.pos_x >= 0.0:
+                pos_x = int(desktop_width * rule.pos_x) + 4
+            else:
+                pos_x = -1
+        else:
+            pos_x = rule.pos_x
+
+        if type(rule.pos_y) == float:
+            if rule.pos_y >= 0.0:
+                pos_y = int(desktop_height * rule.pos_y) + 4
+            else:
+                pos_y = -1
+        else:
+            pos_y = rule.pos_y
+
+        if type(rule.size_x) == float:
+            if rule.size_x >= 0.0:
+                size_x = int(desktop_width * rule.size_x) - 8
+            else:
+                size_x = -1
+        else:
+            size_x = rule.size_x
+
+        if type(rule.size_y) == float:
+            if rule.size_y >= 0.0:
+                size_y = int(desktop_height * rule.size_y) - 8
+            else:
+                size_y = -1
+        else:
+            size_y = rule.size_y
+
+        return pos_x, pos_y, size_x, size_y
+
+    def geometry_settled(self, win, geometry, tolerance):
+
+        """
+        Check whether a window is within tolerance of the given geometry, ignoring anything
+        the rule left unspecified. Window managers tend to adjust geometry slightly to allow
+        for decorations, so exact comparison would never settle.
+        """
+
+        win_geometry = (win.pos_x, win.pos_y, win.size_x, win.size_y)
+
+        for win_value, rule_value in zip(win_geometry, geometry):
+            if rule_value != -1 and abs(win_value - rule_value) > tolerance:
+                return False
+
+        return True
+
+    def apply_rule(self, config, rule, win, geometry=None):
+
+        """
+        Move / resize a single window according to the rule it matched, or to the given
+        geometry if its rule is a layout. Windows that keep needing correcting (e.g. the user
+        keeps moving them back) are backed off from, rather than fought with every pass.
+        """
+
+        win.rule_applied = True
+
+        if win.rule_name != rule.name:
+            win.reset_enforcement(rule.name)
+            self.recall_placement(config, rule, win)
+
+        if rule.place_once and win.placed:
+            return
+
+        if self.apply_pass < win.backoff_until:
+            self.logger_manager.log(Loglevel.DEBUG,
+                                    "{} backed off until pass {}".format(win.win_handle,
+                                                                         win.backoff_until))
+            return
+
+        if geometry is None:
+            geometry = self.get_rule_geometry(rule, rule.desktop)
+
+        needs_move = win.desktop != rule.desktop
+        needs_resize = not self.geometry_settled(win, geometry, config.tolerance)
+
+        if not needs_move and not needs_resize:
+            self.logger_manager.log(Loglevel.DEBUG,
+                                    "{} already in place on {}".format(rule.win_type,
+                                                                       win.desktop))
+            win.corrections = 0
+            win.placed = True
+            self.note_placement()
+
+            if not win.flags_applied:
+                self.apply_rule_flags(rule, win)
+
+            # Windows tiled by a layout each get their own place, so aren't remembered.
+            if self.placement_store is not None and rule.layout is None:
+                self.placement_store.record(win.win_type, rule.name, win.desktop,
+                                            (win.pos_x, win.pos_y, win.size_x, win.size_y),
+                                            config.tolerance)
+
+            return
+
+        win.corrections += 1
+
+        if win.corrections >= config.max_corrections:
+            # Still correct this time, but give the window a chance to settle (or the user to
+            # win) before trying again, backing off further each time.
+            backoff = min(2 ** (win.corrections - config.max_corrections + 1),
+                          config.max_backoff)
+            win.backoff_until = self.apply_pass + backoff
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "{} not settling after {} corrections, backing off for {} passes".format(win.win_handle,
+                                                                                                             win.corrections,
+                                                                                                             backoff))
+
+        win_demaximised = False
+
+        if needs_move:
+            self.logger_manager.log(Loglevel.DEBUG,
+                                    "moving {} to {}".format(rule.win_type,
+                                                             rule.desktop))
+
+            if config.demaximise:
+                # Some DE's will fail to move a window if its maximised, so remove these flags.
+                self.demaximise_window(win)
+                win_demaximised = True
+
+            result = exec_result("wmctrl -i -r {} -t {}".format(win.win_handle,
+                                                                rule.desktop),
+                                 display=self.display)
+
+            if not result.succeeded():
+                raise GenericError("Moving {} to {} failed : {}".format(win.win_handle,
+                                                                        rule.desktop,
+                                                                        result.get_error()))
+
+            win.desktop = rule.desktop
+
+        if needs_resize:
+            pos_x, pos_y, size_x, size_y = geometry
+
+            self.logger_manager.log(Loglevel.INFO,
+                                    "moving {} to ({}x{}) - size ({}x{})".format(rule.win_type,
+                                                                                 pos_x,
+                                                                                 pos_y,
+                                                                                 size_x,
+                                                                                 size_y))
+
+            if config.demaximise and not win_demaximised:
+                # Some DE's will fail to move a window if its maximised, so remove these flags, if we didn't
+                # already do this earlier
+                self.demaximise_window(win)
+
+            result = exec_result("wmctrl -i -r {} -e 0,{},{},{},{}".format(win.win_handle,
+                                                                           pos_x,
+                                                                           pos_y,
+                                                                           size_x,
+                                                                           size_y),
+                                 display=self.display)
+
+            if not result.succeeded():
+                raise GenericError("moving {} to ({}x{}) - size ({}x{}) failed : {}".format(rule.win_type,
+                                                                                            pos_x,
+                                                                                            pos_y,
+                                                                                            size_x,
+                                                                                            size_y,
+                                                                                            result.get_error()))
+
+        win.placed = True
+        self.note_placement()
+        self.apply_rule_flags(rule, win)
+
+    def note_placement(self):
+
+        """
+        Record when the first window was placed, for startup timing.
+        """
+
+        if self.first_placement_time is None:
+            self.first_placement_time = perf_counter()
+
+    def demaximise_window(self, win):
+
+        """
+        Remove any maximised state from a window.
+        """
+
+        result = exec_result("wmctrl -i -r {} -b remove,maximized_vert,maximized_horz".format(win.win_handle),
+                             display=self.display)
+
+        if not result.succeeded():
+            raise GenericError("De-maximising {} failed : {}".format(win.win_handle,
+                                                                     result.get_error()))
+
+    def apply_rule_flags(self, rule, win):
+
+        """
+        Apply a rule's maximise flags to a window.
+        """
+
+        win.flags_applied = True
+
+        if rule.flags & WindowFlag.MAXIMISED:
+            self.set_window_state(win, rule.flags)
+
+    def set_window_state(self, win, flags):
+
+        """
+        Add the given maximise flags to a window.
+        """
+
+        add_flags = ""
+        if flags & WindowFlag.MAX_VERTICAL:
+            add_flags += ",maximized_vert"
+
+        if flags & WindowFlag.MAX_HORIZONTAL:
+            add_flags += ",maximized_horz"
+
+        result = exec_result("wmctrl -i -r {} -b add{}".format(win.win_handle,
+                                                               add_flags),
+                             display=self.display)
+        if not result.succeeded():
+            raise GenericError("Maximising {} failed : {}".format(win.win_handle,
+                                                                  result.get_error()))
+
+    def get_window_state(self, win):
+
+        """
+        Get a window's current maximise flags, which wmctrl does not report, via xprop.
+        """
+
+        result = exec_result("xprop -id {} _NET_WM_STATE".format(win.win_handle),
+                             display=self.display)
+
+        if not result.succeeded():
+            raise GenericError("xprop -id {} failed : {}".format(win.win_handle,
+                                                                 result.get_error()))
+
+        flags = WindowFlag.NONE
+
+        if "_NET_WM_STATE_MAXIMIZED_VERT" in result.stdout:
+            flags |= WindowFlag.MAX_VERTICAL
+
+        if "_NET_WM_STATE_MAXIMIZED_HORZ" in result.stdout:
+            flags |= WindowFlag.MAX_HORIZONTAL
 
+        return flags
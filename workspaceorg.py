@@ -22,86 +22,136 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #   SOFTWARE.
 
+from time import perf_counter
+
+# Taken before anything else is imported, for --timing.
+start_time = perf_counter()
+
 import argparse
 
-from windowmanager import *
-from hardwaremanager import *
-from configmanager import ConfigManager
-from commandmanager import CommandManager
+from configmanager import parse_config_file, get_include_files, load_include_files, \
+    get_displays, get_display_configs, config_needs_hardware, log_shadowed_rules
+from displaysession import DisplaySession, run_display_sessions
+from shellexec import shell_executor
+from utils import NullLogger
 
-from LoggerManager.loggermanager import Logger_Manager, Loglevel
+from LoggerManager.loggermanager import Loglevel
 from exceptions import *
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-from time import sleep, time
 from traceback import format_exc
 
+import_time = perf_counter()
+
 def main():
 
     parser = argparse.ArgumentParser(description='Move certain window types / descriptions onto specified workspaces')
     parser.add_argument('-i', '--input', help='Input config file')
     parser.add_argument('-o', '--output', help='Rules dump output file')
+    parser.add_argument('-s', '--snapshot', help='Layout snapshot file to save to')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append an incremental snapshot to an existing snapshot file')
+    parser.add_argument('-r', '--restore', help='Layout snapshot file to restore from')
+    parser.add_argument('--state-file', help='Memory mapped file to publish window state to')
+    parser.add_argument('--exec-timeout', type=float, default=10.0,
+                        help='Timeout in seconds for wmctrl / xrandr / xprop calls (0 for none)')
+    parser.add_argument('--max-exec', type=int, default=8,
+                        help='Maximum number of commands to run at once')
     parser.add_argument('-l', '--logfile', help='File to log to')
     parser.add_argument('-v', '--verbose', action='store_true', help='Log to standard out')
+    parser.add_argument('--once', action='store_true',
+                        help='Do a single pass of the rules and exit, rather than polling')
+    parser.add_argument('--timing', action='store_true',
+                        help='Print import and first placement times on exit')
 
     args = parser.parse_args()
 
-    if args.input == None and args.output == None:
-        print("Either --input or --output is required")
+    if args.input == None and args.output == None and args.snapshot == None and \
+        args.restore == None:
+        print("One of --input, --output, --snapshot or --restore is required")
         return
 
-    logger_manager = Logger_Manager()
+    # Only set up logging if it was asked for.
+    if args.verbose or args.logfile != None:
+        from LoggerManager.loggermanager import Logger_Manager
 
-    if args.verbose:
-        logger_manager.setup_stdout(Loglevel.INFO)
+        logger_manager = Logger_Manager()
 
-    if args.logfile != None:
-        logger_manager.setup_logfile(args.logfile, 2, Loglevel.INFO)
+        if args.verbose:
+            logger_manager.setup_stdout(Loglevel.INFO)
 
-    try:
-        window_manager = WindowManager(logger_manager)
-        hardware_manager = HardwareManager(logger_manager)
-        config_manager = ConfigManager(logger_manager, window_manager)
-        command_manager = CommandManager(logger_manager)
+        if args.logfile != None:
+            logger_manager.setup_logfile(args.logfile, 2, Loglevel.INFO)
+    else:
+        logger_manager = NullLogger()
 
-        window_manager.set_config_manager(config_manager)
-        command_manager.set_config_manager(config_manager)
+    shell_executor.configure(max(args.max_exec, 1), args.exec_timeout)
 
-        hardware_manager.get_hardware_setup()
+    sessions = []
 
-        window_manager.get_desktop_details()
-
-        if args.output != None:
-            window_manager.get_window_details()
-            window_manager.dump_window_details(args.output)
+    try:
+        config = None
+        include_files = []
 
+        # The main file alone says which displays there are. Included files are read while
+        # those displays are being probed.
         if args.input != None:
+            config = parse_config_file(args.input)
+            include_files = get_include_files(config, args.input)
+            displays = get_displays(config)
+        else:
+            displays = [("default", None)]
 
-            config_manager.get_config_options(args.input)
+        # Monitor details are only used by rules that name a monitor, rules in included
+        # files are checked once they have been read.
+        probe_hardware = config_needs_hardware(config)
 
-            config = config_manager.get_active_config()
+        if len(displays) > 1 and (args.output != None or args.snapshot != None or
+                                         args.restore != None or args.state_file != None):
+            raise ConfigError("--output, --snapshot, --restore and --state-file need a single display")
 
-            start_time = time()
-            time_taken = 0.0
-            loop_counter = 0
+        sessions = [DisplaySession(logger_manager, display_name, display)
+                    for display_name, display in displays]
 
-            while time_taken < config.max_run_time:
+        # Each display's startup probes are independent of every other display's.
+        with ThreadPoolExecutor(max_workers=len(sessions) + 1) as executor:
+            get_configs = [None] * len(sessions)
 
-                logger_manager.log(Loglevel.INFO, "### Loop {} start.".format(loop_counter))
-                loop_counter = loop_counter + 1
+            if config != None:
+                display_configs = executor.submit(read_display_configs, logger_manager, config,
+                                                  args.input, include_files)
+                get_configs = [partial(get_display_config, display_configs, display_index)
+                               for display_index in range(len(sessions))]
 
-                window_manager.get_window_details()
+            list(executor.map(DisplaySession.run_startup_discovery, sessions, get_configs,
+                              [probe_hardware] * len(sessions)))
 
-                window_manager.apply_rules()
+        session = sessions[0]
 
-                logger_manager.log(Loglevel.INFO,
-                                   "### Sleeping for {} secs.".format(config.sleep_time))
+        if args.output != None:
+            session.window_manager.dump_window_details(args.output)
+
+        if args.restore != None:
+            session.get_snapshot_manager().restore_snapshot(args.restore)
+
+        if args.snapshot != None:
+            session.get_snapshot_manager().take_snapshot(args.snapshot, args.incremental)
+            session.snapshot_file = args.snapshot
 
-                sleep(config.sleep_time)
+        if args.state_file != None:
+            from sharedstate import SharedStateWriter
 
-                time_taken = time() - start_time;
+            session.state_writer = SharedStateWriter(session.window_manager, args.state_file)
+            session.state_writer.publish()
 
-            command_manager.launch()
+        if args.input != None and args.once:
+            with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+                list(executor.map(DisplaySession.run_once, sessions))
+
+        elif args.input != None:
+            run_display_sessions(logger_manager, sessions)
 
     except ConfigError as e:
         logger_manager.log(Loglevel.ERROR, e.GetMessage())
@@ -113,7 +163,49 @@ def main():
         logger_manager.log(Loglevel.ERROR, format_exc())
 
     finally:
+        for exec_stats in shell_executor.get_stats():
+            logger_manager.log(Loglevel.INFO, "### Exec {}".format(exec_stats))
+
         logger_manager.log(Loglevel.INFO, "### Script done.")
 
+        if args.timing:
+            print_timing(sessions)
+
+def read_display_configs(logger_manager, config, config_file, include_files):
+
+    """
+    Read a config's included files, then split it into per display configs, warning
+    about any rules that can never match.
+    """
+
+    display_configs = get_display_configs(load_include_files(config, config_file,
+                                                             include_files))
+
+    log_shadowed_rules(logger_manager, display_configs)
+
+    return display_configs
+
+def get_display_config(display_configs, display_index):
+    return display_configs.result()[display_index][2]
+
+def print_timing(sessions):
+
+    """
+    Print startup timings, relative to when we started importing, in a form the startup
+    benchmark can parse.
+    """
+
+    first_placements = [session.window_manager.first_placement_time for session in sessions
+                        if session.window_manager.first_placement_time is not None]
+
+    first_placement = -1.0
+
+    if first_placements:
+        first_placement = (min(first_placements) - start_time) * 1000
+
+    print("timing import_ms={:.2f} first_placement_ms={:.2f} total_ms={:.2f}".format((import_time - start_time) * 1000,
+                                                                                   first_placement,
+                                                                                   (perf_counter() - start_time) * 1000))
+
 if __name__ == "__main__":
     exit(main())